@@ -60,6 +60,9 @@ Requires: globus-common-progs
 # We use shar files for globus-job-run
 Requires: sharutils
 
+# The metric runtime log is rotated
+Requires: logrotate
+
 %if %systemd
 Requires(post):		systemd
 Requires(preun):	systemd
@@ -241,6 +244,7 @@ fi
 
 %config(noreplace) %{_sysconfdir}/rsv/consumers.conf
 %config(noreplace) %{_sysconfdir}/rsv/rsv.conf
+%config(noreplace) %{_sysconfdir}/logrotate.d/rsv-core
 
 %{python_sitelib}/rsv/*
 
@@ -3,32 +3,254 @@
 import os
 import re
 import pwd
+import sys
 import time
 import commands
+import subprocess
 from time import strftime
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+# Talk to condor-cron through the HTCondor Python bindings when they are
+# installed.  Otherwise we run the condor_cron_* commands.
+try:
+    import htcondor
+except ImportError:
+    htcondor = None
+
 import Host
 
+# condor-cron runs its own schedd with its own configuration
+CONDOR_CRON_CONFIG = os.path.join("/", "etc", "condor-cron", "condor_config")
+
+# Exceptions the Python bindings raise when talking to the schedd fails
+BINDINGS_ERRORS = (RuntimeError, IOError, ValueError, TypeError)
+
+# The job attributes rsv-control looks at.  Only these are fetched for the queue snapshot.
+SNAPSHOT_ATTRIBUTES = ["ClusterId", "ProcId", "Owner", "JobStatus", "EnteredCurrentStatus", "DeferralTime",
+                       "OSGRSV", "OSGRSVHost", "OSGRSVMetric", "OSGRSVUniqueName", "OSGRSVProbeInterval",
+                       "OSGRSVSubmitHash"]
+
+# The attributes the queue snapshot is indexed by
+SNAPSHOT_INDEXES = ["OSGRSVUniqueName", "OSGRSVHost", "OSGRSV"]
+
+class QueueSnapshot:
+    """ The RSV jobs in the condor-cron queue, indexed by OSGRSVUniqueName, OSGRSVHost
+    and OSGRSV.  The classads hold values the way condor_cron_q prints them (string
+    values keep their quotes), but the indexes use the unquoted values. """
+
+    def __init__(self, classads):
+        self.classads = []
+        self.indexes = {}
+        for attribute in SNAPSHOT_INDEXES:
+            self.indexes[attribute] = {}
+
+        for classad in classads:
+            self.add(classad)
+
+
+    def add(self, classad):
+        """ Add a job to the snapshot """
+        self.classads.append(classad)
+        for attribute in SNAPSHOT_INDEXES:
+            if attribute in classad:
+                value = classad[attribute].strip('"')
+                self.indexes[attribute].setdefault(value, []).append(classad)
+
+
+    def find(self, attribute, value):
+        """ Return the jobs whose (indexed) attribute equals value """
+        return list(self.indexes[attribute].get(value, []))
+
+
+    def remove(self, attribute, value):
+        """ Drop the jobs whose (indexed) attribute equals value """
+
+        removed = self.find(attribute, value)
+        remaining = []
+        for classad in self.classads:
+            keep = True
+            for other in removed:
+                if classad is other:
+                    keep = False
+            if keep:
+                remaining.append(classad)
+
+        self.__init__(remaining)
+
+
+class SubmitJob:
+    """ A metric or consumer job to be submitted to condor-cron """
+
+    def __init__(self, condor_id, job_type, attributes, host=None, metric_name=None):
+        self.condor_id = condor_id
+        self.job_type = job_type
+        self.attributes = attributes
+        self.host = host
+        self.metric_name = metric_name
+        self.job_id = None
+
+
+    def get_submit_hash(self):
+        """ Return the hash of the job's submit description (see add_submit_hash) """
+        for (name, value) in self.attributes:
+            if name == "+OSGRSVSubmitHash":
+                return value.strip('"')
+        return None
+
+
+    def get_shape(self):
+        """ Return the names of the attributes the job sets, for grouping jobs """
+        names = [pair[0] for pair in self.attributes]
+        names.sort()
+        return tuple(names)
+
+
 class Condor:
     """ Define the interface to condor-cron """
 
-    def __init__(self, rsv):
+    def __init__(self, rsv, hostname=None):
         self.rsv = rsv
 
+        # If hostname is set only the jobs for that host are fetched from the schedd.
+        # That is enough for displaying them but not for starting jobs, since the
+        # consumers would look like they are not running.
+        self.hostname = hostname
+
+        # The RSV jobs in the queue are fetched once and then kept up to date as we
+        # submit and remove jobs.  snapshot_error is set if the fetch failed.
+        self.snapshot = None
+        self.snapshot_error = None
+
+        # The condor-cron schedd, if the Python bindings can be used.  False means
+        # that we tried and could not find it.
+        self.schedd = None
+
+
+    def get_schedd(self):
+        """ Return the condor-cron Schedd object from the Python bindings, or None if
+        the bindings are not installed or cannot be used """
+
+        if htcondor is None or self.schedd is False:
+            return None
+
+        if self.schedd is not None:
+            return self.schedd
+
+        # The bindings read their configuration from CONDOR_CONFIG.  Point them at
+        # condor-cron only while loading it so that jobs we run do not inherit it.
+        old_config = os.environ.get("CONDOR_CONFIG")
+        os.environ["CONDOR_CONFIG"] = CONDOR_CRON_CONFIG
+        try:
+            try:
+                htcondor.reload_config()
+                self.schedd = htcondor.Schedd()
+                self.rsv.log("DEBUG", "Using the HTCondor Python bindings to talk to condor-cron")
+            except BINDINGS_ERRORS, err:
+                self.rsv.log("INFO", "Cannot use the HTCondor Python bindings (%s).  Using condor_cron commands." % err)
+                self.schedd = False
+        finally:
+            if old_config is None:
+                del os.environ["CONDOR_CONFIG"]
+            else:
+                os.environ["CONDOR_CONFIG"] = old_config
+
+        if self.schedd is False:
+            return None
+        return self.schedd
+
+
+    def disable_bindings(self, action, err):
+        """ Stop using the Python bindings after a call through them failed, so that
+        this and later calls use the condor_cron commands """
+        self.rsv.log("INFO", "%s with the Python bindings failed (%s).  Using condor_cron commands." % (action, err))
+        self.schedd = False
+
+
+    def query(self, constraint=None, attributes=None):
+        """ Return the classads of the jobs matching constraint, with only the listed
+        attributes if attributes is supplied.  Each classad is a dict with the values
+        written the way 'condor_cron_q -l' prints them (attributes that are not
+        defined for a job are left out).
+        Returns (True, classads) on success and (False, error message) otherwise. """
+
+        schedd = self.get_schedd()
+        if schedd is not None:
+            if constraint is None:
+                constraint = "true"
+            try:
+                if attributes:
+                    ads = schedd.query(constraint, attributes)
+                else:
+                    ads = schedd.query(constraint)
+                return True, [classad_to_dict(ad) for ad in ads]
+            except BINDINGS_ERRORS, err:
+                self.disable_bindings("Query", err)
+
+        # With a list of attributes ask for just those, one job per line with the
+        # values separated by tabs.  The 'r' keeps string values quoted as in -l.
+        if attributes:
+            cmd = "condor_cron_q -af:rt %s" % " ".join(attributes)
+        else:
+            cmd = "condor_cron_q -l"
+        if constraint is not None:
+            cmd += " -constraint '%s'" % constraint
+
+        (ret, out) = self.commands_getstatusoutput(cmd)
+
+        if ret != 0:
+            self.rsv.log("DEBUG", "Command returned error code '%i': '%s'" % (ret, cmd))
+            return False, out
+
+        if attributes:
+            return True, parse_autoformat(out, attributes)
+        return True, parse_classads(out)
+
+
+    def get_snapshot(self, refresh=False):
+        """ Return a QueueSnapshot of the RSV jobs in condor-cron, or None if
+        condor-cron could not be queried.  The queue is only queried once unless
+        refresh is True. """
+
+        if refresh:
+            self.snapshot = None
+            self.snapshot_error = None
+
+        if self.snapshot is not None:
+            return self.snapshot
+
+        if self.snapshot_error is not None:
+            return None
+
+        constraint = "OSGRSV =!= undefined"
+        if self.hostname:
+            constraint = "OSGRSVHost == \"%s\"" % self.hostname
+
+        (ok, result) = self.query(constraint, SNAPSHOT_ATTRIBUTES)
+
+        if not ok:
+            self.snapshot_error = result
+            return None
+
+        self.snapshot = QueueSnapshot(result)
+        self.rsv.log("DEBUG", "Found %s RSV jobs in Condor-Cron" % len(self.snapshot.classads))
+        return self.snapshot
+
 
     def is_condor_running(self):
         """
         Determine if Condor-Cron is running.  Return True is so, false otherwise
         """
 
-        (ret, out) = self.commands_getstatusoutput("condor_cron_q")
-
-        if not ret:
-            self.rsv.log("DEBUG", "Condor is running.  Output of condor_cron_q:\n%s" % out)
+        if self.get_snapshot() is not None:
+            self.rsv.log("DEBUG", "Condor is running")
             return True
 
         self.rsv.log("INFO", "Condor-Cron does not seem to be running.  " +
-                     "Output of condor_cron_q:\n%s" % out)
+                     "Output of condor_cron_q:\n%s" % self.snapshot_error)
 
         return False
 
@@ -39,23 +261,40 @@ class Condor:
         Return false if it is not
         """
 
-        classads = self.get_classads("OSGRSVUniqueName==\"%s\"" % condor_id)
+        snapshot = self.get_snapshot()
 
-        if classads is None:
+        if snapshot is None:
             self.rsv.log("ERROR", "Could not determine if job is running")
             return False
 
-        for classad in classads:
-            # We put the attribute into the classad in quotes, so search for it accordingly
-            if classad["OSGRSVUniqueName"] == '"' + condor_id + '"':
-                return True
+        if snapshot.find("OSGRSVUniqueName", condor_id):
+            return True
 
         return False
 
 
-    def get_classads(self, constraint=None):
+    def remember_job(self, cluster_id, proc_id, job):
+        """ Add a SubmitJob we just submitted to the queue snapshot """
+
+        if self.snapshot is None:
+            return
+
+        classad = {"ClusterId": str(cluster_id), "ProcId": str(proc_id), "JobStatus": "1",
+                   "Owner": '"%s"' % self.rsv.get_user(),
+                   "OSGRSV": '"%s"' % job.job_type, "OSGRSVUniqueName": '"%s"' % job.condor_id}
+        if job.host:
+            classad["OSGRSVHost"] = '"%s"' % job.host
+        if job.metric_name:
+            classad["OSGRSVMetric"] = '"%s"' % job.metric_name
+        if job.get_submit_hash():
+            classad["OSGRSVSubmitHash"] = '"%s"' % job.get_submit_hash()
+        self.snapshot.add(classad)
+
+
+    def get_classads(self, constraint=None, attributes=None):
         """
-        Run a condor_cron_q command and return a dict of the classad.
+        Query condor-cron and return a list of classads (dicts), containing only
+        the listed attributes if attributes is supplied.
         If there is an error, return None
         """
         if constraint:
@@ -63,39 +302,31 @@ class Condor:
         else:
             self.rsv.log("DEBUG", "Getting Condor classads with no constraint")
 
-        if not self.is_condor_running():
-            self.rsv.log("ERROR", "Cannot fetch classads because Condor-Cron is not running")
-            return None
+        (ok, result) = self.query(constraint, attributes)
 
-        # Build the command
-        cmd = "condor_cron_q -l"
-        if  constraint is not None:
-            cmd += " -constraint '%s'" % constraint
-
-        (ret, out) = self.commands_getstatusoutput(cmd)
-
-        # Run the command and parse the classad
-        if ret != 0:
-            self.rsv.log("ERROR", "Command returned error code '%i': '%s'" % (ret, cmd))
+        if not ok:
+            self.rsv.log("ERROR", "Could not query Condor-Cron: %s" % result)
             return None
         else:
-            return parse_classads(out)
+            return result
 
 
     def number_of_running_metrics(self):
         """ Return the number of running metrics """
-        try:
-            return len(self.get_classads("OSGRSV==\"metrics\""))
-        except TypeError:
+        snapshot = self.get_snapshot()
+        if snapshot is None:
             self.rsv.log("ERROR", "Classad parsing failed, unable to count running metrics")
+            return None
+        return len(snapshot.find("OSGRSV", "metrics"))
 
 
     def number_of_running_consumers(self):
         """ Return the number of running consumers """
-        try:
-            return len(self.get_classads("OSGRSV==\"consumers\""))
-        except TypeError:
+        snapshot = self.get_snapshot()
+        if snapshot is None:
             self.rsv.log("ERROR", "Classad parsing failed, unable to count running consumers")
+            return None
+        return len(snapshot.find("OSGRSV", "consumers"))
 
 
     def start_metric(self, metric, host):
@@ -103,60 +334,183 @@ class Condor:
         Start a single metric condor-cron job.
         Takes a Metric and Host object as input.
         """
-        
-        self.rsv.log("INFO", "Submitting metric job to condor: metric '%s' - host '%s'" %
-                     (metric.name, metric.host))
 
-        condor_id = metric.get_unique_name()
+        return self.start_jobs([(metric, host)], []) == 0
 
-        # Make sure that the metric is enabled
-        if not host.metric_enabled(metric.name):
-            self.rsv.log("ERROR", "The metric '%s' is not enabled on host '%s'." %
-                         (metric.name, host.host))
-            return False
 
-        # Check if the metric is already running in condor_cron
-        if self.is_job_running(condor_id):
-            self.rsv.log("INFO", "Metric '%s' is already running against host '%s'" %
-                         (metric.name, host.host))
-            return True
+    def start_consumer(self, rsv, consumer):
+        """ Start a single consumer condor-cron job. """
 
-        # Generate a submission file
-        submit_file_contents = self.build_metric_submit_file(metric)
+        return self.start_jobs([], [consumer]) == 0
 
-        return self.submit_job(submit_file_contents, condor_id)
 
+    def start_jobs(self, metrics, consumers):
+        """
+        Start metric and consumer condor-cron jobs.  metrics is a list of (Metric, Host)
+        pairs.  Jobs that are already running are left alone, and the rest are
+        submitted together (see submit_jobs).
+        Returns the number of jobs that could not be started.
+        """
 
-    def start_consumer(self, rsv, consumer):
-        """ Start a single consumer condor-cron job. """
-        
-        self.rsv.log("INFO", "Submitting consumer job to condor: consumer '%s'" % consumer)
+        num_errors = 0
+        jobs = []
+
+        for (metric, host) in metrics:
+            self.rsv.log("INFO", "Submitting metric job to condor: metric '%s' - host '%s'" %
+                         (metric.name, metric.host))
+
+            condor_id = metric.get_unique_name()
+
+            # Make sure that the metric is enabled
+            if not host.metric_enabled(metric.name):
+                self.rsv.log("ERROR", "The metric '%s' is not enabled on host '%s'." %
+                             (metric.name, host.host))
+                num_errors += 1
+                continue
+
+            # Check if the metric is already running in condor_cron
+            if self.is_job_running(condor_id):
+                self.rsv.log("INFO", "Metric '%s' is already running against host '%s'" %
+                             (metric.name, host.host))
+                continue
+
+            job = self.get_metric_job(metric)
+            if job is None:
+                num_errors += 1
+                continue
+
+            jobs.append(job)
+
+        for consumer in consumers:
+            self.rsv.log("INFO", "Submitting consumer job to condor: consumer '%s'" % consumer)
+
+            condor_id = consumer.get_unique_name()
+
+            # Check if the consumer is enabled
+            if not self.rsv.is_consumer_enabled(consumer.name):
+                self.rsv.log("ERROR", "The consumer '%s' is not enabled." % consumer.name)
+                num_errors += 1
+                continue
+
+            # Check if the consumer is already running in condor_cron
+            if self.is_job_running(condor_id):
+                self.rsv.log("INFO", "Consumer '%s' is already running" % consumer.name)
+                continue
+
+            jobs.append(self.get_consumer_job(consumer))
+
+        if jobs:
+            num_errors += self.submit_jobs(jobs)
+
+        return num_errors
 
-        condor_id = consumer.get_unique_name()
 
-        # Check if the consumer is enabled
-        if not rsv.is_consumer_enabled(consumer.name):
-            self.rsv.log("ERROR", "The consumer '%s' is not enabled." % consumer.name)
+    def submit_jobs(self, jobs):
+        """
+        Submit several SubmitJobs to condor-cron, with one condor_cron_submit per group
+        of jobs that set the same attributes.  Within a submit file each job sets all
+        of its attributes before its Queue statement, so grouping by attribute names
+        guarantees that no job inherits a setting from the job before it.
+        Each job's ID is stored in its job_id.
+        Returns the number of jobs that could not be submitted.
+        """
+
+        # Group the jobs, keeping the order they were given in
+        groups = []
+        groups_by_shape = {}
+        for job in jobs:
+            shape = job.get_shape()
+            if shape not in groups_by_shape:
+                groups_by_shape[shape] = []
+                groups.append(groups_by_shape[shape])
+            groups_by_shape[shape].append(job)
+
+        num_errors = 0
+        for index in range(len(groups)):
+            group = groups[index]
+            if self.submit_with_bindings(group):
+                continue
+
+            contents = build_submit_file([job.attributes for job in group])
+            self.rsv.log("DEBUG", "Submit file for %s jobs:\n%s" % (len(group), contents), 4)
+
+            (ok, out) = self.run_submit(contents, "rsv-jobs-%s-%s" % (os.getpid(), index))
+            if not ok:
+                num_errors += len(group)
+                continue
+
+            # All jobs from one submit file end up in one cluster, in order
+            match = re.search("(\d+) job\(s\) submitted to cluster (\d+)\.", out)
+            if not match or int(match.group(1)) != len(group):
+                self.rsv.log("ERROR", "Could not determine job IDs of %s jobs from output:\n%s" % (len(group), out))
+                self.snapshot = None
+                num_errors += len(group)
+                continue
+
+            cluster_id = match.group(2)
+            for proc_id in range(len(group)):
+                job = group[proc_id]
+                job.job_id = "%s.%s" % (cluster_id, proc_id)
+                self.rsv.log("INFO", "Submitted %s as job %s" % (job.condor_id, job.job_id))
+                self.remember_job(cluster_id, proc_id, job)
+
+        return num_errors
+
+
+    def submit_with_bindings(self, jobs):
+        """
+        Submit SubmitJobs through the Python bindings, all in one transaction.  This
+        is only done if we are already running as the RSV user, since the jobs have
+        to be owned by that user.  Returns True if the jobs were submitted and False
+        if they still need to be submitted with condor_cron_submit.
+        """
+
+        schedd = self.get_schedd()
+        if schedd is None or not hasattr(htcondor, "Submit"):
             return False
 
-        # Check if the consumer is already running in condor_cron
-        if self.is_job_running(condor_id):
-            self.rsv.log("INFO", "Consumer '%s' is already running" % consumer.name)
-            return True
+        if os.getuid() != pwd.getpwnam(self.rsv.get_user()).pw_uid:
+            return False
+
+        cluster_ids = []
+        try:
+            # This is what a 'with' block would do, but we need to run on old Pythons
+            transaction = schedd.transaction()
+            transaction.__enter__()
+            try:
+                for job in jobs:
+                    # The bindings would use our working directory as the job's Iwd,
+                    # which the RSV user may not be able to read (see run_submit)
+                    description = dict(job.attributes)
+                    description["initialdir"] = os.path.join("/", "tmp")
+                    submit = htcondor.Submit(description)
+                    cluster_ids.append(submit.queue(transaction))
+            except:
+                if not transaction.__exit__(*sys.exc_info()):
+                    raise
+            else:
+                transaction.__exit__(None, None, None)
+        except BINDINGS_ERRORS, err:
+            self.rsv.log("INFO", "Submission with the Python bindings failed (%s).  Using condor_cron_submit." % err)
+            return False
+
+        for index in range(len(jobs)):
+            job = jobs[index]
+            job.job_id = "%s.0" % cluster_ids[index]
+            self.rsv.log("INFO", "Submitted %s as job %s" % (job.condor_id, job.job_id))
+            self.remember_job(cluster_ids[index], 0, job)
 
-        # Generate a submission file
-        submit_file_contents = self.build_consumer_submit_file(consumer)
-        self.rsv.log("DEBUG", "%s submit file:\n%s" % (consumer.name, submit_file_contents), 4)
-        return self.submit_job(submit_file_contents, condor_id)
+        return True
 
 
-    def submit_job(self, submit_file_contents, condor_id, dir="/tmp", remove=1):
+    def run_submit(self, submit_file_contents, name, dir="/tmp", remove=1, env=None):
         """
-        Input: submit file contents and job identifier
-        Create submission file, submits it to Condor and removes it
+        Write a submission file, submit it to Condor and remove it.
+        If env is supplied condor_cron_submit is run with that environment.
+        Returns (True, output) on success and (False, output) otherwise.
         """
 
-        sub_file_name = os.path.join(dir, condor_id + ".sub")
+        sub_file_name = os.path.join(dir, name + ".sub")
         try:
             file_handle = open(sub_file_name, 'w')
             file_handle.write(submit_file_contents)
@@ -164,7 +518,7 @@ class Condor:
         except IOError, err:
             self.rsv.log("ERROR", "Cannot write temporary submission file '%s'." % sub_file_name)
             self.rsv.log("ERROR", "Error message: %s" % err)
-            return False
+            return False, ""
 
         # We need to change to a directory that can be read by the RSV user.  This is
         # because Condor puts the current working directory into the job ad as 'Iwd'
@@ -174,7 +528,7 @@ class Condor:
 
         # Submit the job and remove the file
         cmd = "condor_cron_submit %s" % sub_file_name
-        raw_ec, out = self.commands_getstatusoutput(cmd, self.rsv.get_user())
+        raw_ec, out = self.commands_getstatusoutput(cmd, self.rsv.get_user(), env)
         exit_code = os.WEXITSTATUS(raw_ec)
         self.rsv.log("INFO", "Condor submission: %s" % out)
         self.rsv.log("DEBUG", "Condor submission completed: %s (%s)" % (exit_code, raw_ec))
@@ -184,6 +538,21 @@ class Condor:
 
         if exit_code != 0:
             self.rsv.log("ERROR", "Problem submitting job to condor.  Command output:\n%s" % out)
+            return False, out
+
+        return True, out
+
+
+    def submit_job(self, submit_file_contents, condor_id, dir="/tmp", remove=1, env=None):
+        """
+        Input: submit file contents and job identifier
+        Create submission file, submits it to Condor and removes it.
+        If env is supplied condor_cron_submit is run with that environment.
+        Returns the cluster ID, or False on failure.
+        """
+
+        (ok, out) = self.run_submit(submit_file_contents, condor_id, dir, remove, env)
+        if not ok:
             return False
 
         # Determine the job cluster ID
@@ -205,12 +574,8 @@ class Condor:
 
         self.rsv.log("INFO", "Stopping all metrics with constraint '%s'" % constraint)
 
-        if not self.is_condor_running():
-            self.rsv.log("ERROR", "Cannot stop jobs because Condor-Cron is not running")
-            return False
-
         # Check if any jobs are running to be removed
-        jobs = self.get_classads(constraint)
+        jobs = self.get_classads(constraint, ["ClusterId", "ProcId"])
         if jobs is None:
             self.rsv.log("ERROR", "Problem stopping RSV jobs.  Condor may not be running")
             return False
@@ -218,10 +583,86 @@ class Condor:
             self.rsv.log("INFO", "No jobs to be removed with constraint '%s'" % constraint)
             return True
 
-        # Build the command
-        cmd = "condor_cron_rm"
-        if constraint is not None:
-            cmd += " -constraint '%s'" % constraint
+        if not self.remove_jobs(constraint):
+            return False
+
+        # We cannot tell which RSV jobs matched, so the snapshot has to be fetched again
+        self.snapshot = None
+        return True
+
+
+    def stop_rsv_jobs(self, attribute, value):
+        """
+        Stop the RSV jobs whose attribute (OSGRSV, OSGRSVHost or OSGRSVUniqueName)
+        equals value.  The queue snapshot is used to find out if there is anything to
+        remove.  Return True if jobs are stopped successfully, False otherwise
+        """
+
+        constraint = "%s==\"%s\"" % (attribute, value)
+        self.rsv.log("INFO", "Stopping all metrics with constraint '%s'" % constraint)
+
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            self.rsv.log("ERROR", "Cannot stop jobs because Condor-Cron is not running")
+            return False
+
+        if not snapshot.find(attribute, value):
+            self.rsv.log("INFO", "No jobs to be removed with constraint '%s'" % constraint)
+            return True
+
+        if not self.remove_jobs(constraint):
+            return False
+
+        snapshot.remove(attribute, value)
+        return True
+
+
+    def stop_unique_names(self, unique_names):
+        """
+        Stop the RSV jobs with any of the supplied OSGRSVUniqueNames using a single
+        remove request.  Names that are not in the queue snapshot are skipped.
+        Return True if jobs are stopped successfully, False otherwise
+        """
+
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            self.rsv.log("ERROR", "Cannot stop jobs because Condor-Cron is not running")
+            return False
+
+        running = []
+        for name in unique_names:
+            if snapshot.find("OSGRSVUniqueName", name):
+                running.append(name)
+            else:
+                self.rsv.log("INFO", "Job '%s' is not running" % name)
+
+        if not running:
+            return True
+
+        clauses = ["OSGRSVUniqueName==\"%s\"" % name for name in running]
+        self.rsv.log("INFO", "Stopping %s RSV jobs: %s" % (len(running), " ".join(running)))
+
+        if not self.remove_jobs(" || ".join(clauses)):
+            return False
+
+        for name in running:
+            snapshot.remove("OSGRSVUniqueName", name)
+        return True
+
+
+    def remove_jobs(self, constraint):
+        """ Remove the jobs matching constraint from condor-cron """
+
+        schedd = self.get_schedd()
+        if schedd is not None:
+            try:
+                result = schedd.act(htcondor.JobAction.Remove, constraint)
+                self.rsv.log("DEBUG", "Removed %s jobs with constraint '%s'" % (result["TotalSuccess"], constraint))
+                return True
+            except BINDINGS_ERRORS, err:
+                self.disable_bindings("Removal", err)
+
+        cmd = "condor_cron_rm -constraint '%s'" % constraint
 
         (ret, out) = self.commands_getstatusoutput(cmd)
 
@@ -233,14 +674,27 @@ class Condor:
         return True
         
 
-    def build_metric_submit_file(self, metric):
-        """ Create a submission file for a metric """
+    def get_metric_job(self, metric):
+        """ Return a SubmitJob for a metric, or None if the metric cannot be started """
+        attributes = self.get_metric_submit_attributes(metric)
+        if not attributes:
+            return None
+        return SubmitJob(metric.get_unique_name(), "metrics", attributes, metric.host, metric.name)
+
+
+    def get_consumer_job(self, consumer):
+        """ Return a SubmitJob for a consumer """
+        return SubmitJob(consumer.get_unique_name(), "consumers", self.get_consumer_submit_attributes(consumer))
+
+
+    def get_metric_submit_attributes(self, metric):
+        """ Return the submit file settings for a metric as a list of (name, value)
+        pairs, or None if the metric cannot be started """
 
         log_dir = self.rsv.get_metric_log_dir()
-        environment = "PATH=/usr/bin:/bin\n"
+        environment = "PATH=/usr/bin:/bin"
         condor_id = metric.get_unique_name()
         arguments = "-v 3 -r -u %s %s %s" % (metric.host, metric.name, metric.get_settings())
-        timestamp = strftime("%Y-%m-%d %H:%M:%S %Z")
 
         probe_interval = metric.get_probe_interval()
         if not probe_interval:
@@ -248,48 +702,44 @@ class Condor:
             if not cron:
                 self.rsv.log("ERROR", "Invalid cron time for metric %s on host %s.  Will not start." %
                              (metric.name, metric.host))
-                return ""
+                return None
 
-        submit = ""
-        submit += "######################################################################\n"
-        submit += "# Temporary submit file generated by rsv-control\n"
-        submit += "# Generated at %s " % timestamp
-        submit += "######################################################################\n"
-        submit += "Environment = %s\n"    % environment
+        attributes = []
+        attributes.append(("Environment", environment))
 
         if probe_interval:
-            submit += "DeferralPrepTime = ifThenElse(%d - ScheddInterval + 31 > 0, %d - ScheddInterval + 31, 180) \n" % (probe_interval, probe_interval)
-            submit += "DeferralTime = (CurrentTime + %d + random(30))\n" % probe_interval
-            submit += "DeferralWindow = 99999999\n"
-            submit += "+OSGRSVProbeInterval = %d\n" % probe_interval
+            attributes.append(("DeferralPrepTime", "ifThenElse(%d - ScheddInterval + 31 > 0, %d - ScheddInterval + 31, 180)" % (probe_interval, probe_interval)))
+            attributes.append(("DeferralTime", "(CurrentTime + %d + random(30))" % probe_interval))
+            attributes.append(("DeferralWindow", "99999999"))
+            attributes.append(("+OSGRSVProbeInterval", "%d" % probe_interval))
         else:
-            submit += "CronPrepTime = 180\n"
-            submit += "CronWindow = 99999999\n"
-            submit += "CronMonth = %s\n"      % cron["Month"]
-            submit += "CronDayOfWeek = %s\n"  % cron["DayOfWeek"]
-            submit += "CronDayOfMonth = %s\n" % cron["DayOfMonth"]
-            submit += "CronHour = %s\n"       % cron["Hour"]
-            submit += "CronMinute = %s\n"     % cron["Minute"]
-        submit += "Executable = %s\n"     % self.rsv.get_wrapper()
-        submit += "Error = %s/%s.err\n"   % (log_dir, condor_id)
-        submit += "Output = %s/%s.out\n"  % (log_dir, condor_id)
-        submit += "Log = %s/%s.log\n"     % (log_dir, condor_id)
-        submit += "Arguments = %s\n"      % arguments
-        submit += "Universe = local\n"
-        submit += "Notification = never\n"
-        submit += "OnExitRemove = false\n"
-        submit += "PeriodicRelease = HoldReasonCode =!= 1\n"
-        submit += "+OSGRSV = \"metrics\"\n"
-        submit += "+OSGRSVHost = \"%s\"\n" % metric.host
-        submit += "+OSGRSVMetric = \"%s\"\n" % metric.name
-        submit += "+OSGRSVUniqueName = \"%s\"\n" % condor_id
-        submit += "Queue\n"
-        
-        return submit
-
-
-    def build_consumer_submit_file(self, consumer):
-        """ Create a submission file for a consumer """
+            attributes.append(("CronPrepTime", "180"))
+            attributes.append(("CronWindow", "99999999"))
+            attributes.append(("CronMonth", cron["Month"]))
+            attributes.append(("CronDayOfWeek", cron["DayOfWeek"]))
+            attributes.append(("CronDayOfMonth", cron["DayOfMonth"]))
+            attributes.append(("CronHour", cron["Hour"]))
+            attributes.append(("CronMinute", cron["Minute"]))
+        attributes.append(("Executable", self.rsv.get_wrapper()))
+        attributes.append(("Error", "%s/%s.err" % (log_dir, condor_id)))
+        attributes.append(("Output", "%s/%s.out" % (log_dir, condor_id)))
+        attributes.append(("Log", "%s/%s.log" % (log_dir, condor_id)))
+        attributes.append(("Arguments", arguments))
+        attributes.append(("Universe", "local"))
+        attributes.append(("Notification", "never"))
+        attributes.append(("OnExitRemove", "false"))
+        attributes.append(("PeriodicRelease", "HoldReasonCode =!= 1"))
+        attributes.append(("+OSGRSV", "\"metrics\""))
+        attributes.append(("+OSGRSVHost", "\"%s\"" % metric.host))
+        attributes.append(("+OSGRSVMetric", "\"%s\"" % metric.name))
+        attributes.append(("+OSGRSVUniqueName", "\"%s\"" % condor_id))
+        add_submit_hash(attributes)
+
+        return attributes
+
+
+    def get_consumer_submit_attributes(self, consumer):
+        """ Return the submit file settings for a consumer as a list of (name, value) pairs """
         log_dir = self.rsv.get_consumer_log_dir()
 
         environment = "PATH=/usr/bin:/bin;"
@@ -297,35 +747,32 @@ class Condor:
 
         condor_id = consumer.get_unique_name()
         arguments = consumer.get_args_string()
-        timestamp = strftime("%Y-%m-%d %H:%M:%S %Z")
-
-        submit = ""
-        submit += "######################################################################\n"
-        submit += "# Temporary submit file generated by rsv-control\n"
-        submit += "# Generated at %s\n" % timestamp
-        submit += "######################################################################\n"
-        submit += "Arguments = %s\n" % arguments
-        submit += "DeferralPrepTime = 180\n"
-        submit += "DeferralTime = (CurrentTime + 300 + random(30))\n"
-        submit += "DeferralWindow = 99999999\n"
-        submit += "Environment = %s\n"    % environment
-        submit += "Executable = %s\n"     % consumer.executable
-        submit += "Error = %s/%s.err\n"   % (log_dir, condor_id)
-        submit += "Output = %s/%s.out\n"  % (log_dir, condor_id)
-        submit += "Log = %s/%s.log\n"     % (log_dir, condor_id)
-        submit += "Universe = local\n"
-        submit += "Notification = never\n"
-        submit += "OnExitRemove = false\n"
-        submit += "PeriodicRelease = (HoldReasonCode =!= 1) " + \
-                  "&& ((CurrentTime - EnteredCurrentStatus) > 60)\n"
-        submit += "+OSGRSV = \"consumers\"\n"
-        submit += "+OSGRSVUniqueName = \"%s\"\n" % condor_id
-        submit += "Queue\n"
-
-        return submit
 
-    def commands_getstatusoutput(self, command, user=None):
-        """Run a command in a subshell using commands module and setting up the environment"""
+        attributes = []
+        attributes.append(("Arguments", arguments))
+        attributes.append(("DeferralPrepTime", "180"))
+        attributes.append(("DeferralTime", "(CurrentTime + 300 + random(30))"))
+        attributes.append(("DeferralWindow", "99999999"))
+        attributes.append(("Environment", environment))
+        attributes.append(("Executable", consumer.executable))
+        attributes.append(("Error", "%s/%s.err" % (log_dir, condor_id)))
+        attributes.append(("Output", "%s/%s.out" % (log_dir, condor_id)))
+        attributes.append(("Log", "%s/%s.log" % (log_dir, condor_id)))
+        attributes.append(("Universe", "local"))
+        attributes.append(("Notification", "never"))
+        attributes.append(("OnExitRemove", "false"))
+        attributes.append(("PeriodicRelease", "(HoldReasonCode =!= 1) " +
+                           "&& ((CurrentTime - EnteredCurrentStatus) > 60)"))
+        attributes.append(("+OSGRSV", "\"consumers\""))
+        attributes.append(("+OSGRSVUniqueName", "\"%s\"" % condor_id))
+        add_submit_hash(attributes)
+
+        return attributes
+
+
+    def commands_getstatusoutput(self, command, user=None, env=None):
+        """Run a command in a subshell using commands module and setting up the environment.
+        If env is supplied the command is run with that environment instead of ours."""
         self.rsv.log("DEBUG", "commands_getstatusoutput: command='%s' user='%s'" % (command, user))
 
         if user:
@@ -341,7 +788,22 @@ class Condor:
                                   (user, pwd.getpwuid(this_uid).pw_name))
                     return 1, ""
 
-        ret, out = commands.getstatusoutput(command)
+        if env is None:
+            ret, out = commands.getstatusoutput(command)
+            return ret, out
+
+        # Same behavior as commands.getstatusoutput, but with our own environment:
+        # STDERR is merged into STDOUT, one trailing newline is stripped, and the
+        # status is encoded the way os.wait() reports it.
+        p = subprocess.Popen(command, shell=True, stdin=open(os.devnull), stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, env=env)
+        out = p.communicate()[0]
+        if out[-1:] == "\n":
+            out = out[:-1]
+        if p.returncode < 0:
+            ret = -p.returncode
+        else:
+            ret = p.returncode << 8
         return ret, out
 
 
@@ -391,7 +853,15 @@ class Condor:
         #
         hosts = {}
         running_metrics = {}
-        classads = self.get_classads("OSGRSV==\"metrics\"")
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            self.rsv.echo("ERROR: Could not query condor-cron")
+            return False
+
+        if hostname:
+            classads = snapshot.find("OSGRSVHost", hostname)
+        else:
+            classads = snapshot.find("OSGRSV", "metrics")
 
         if not classads:
             if parsable:
@@ -448,7 +918,7 @@ class Condor:
         # Show the consumers also if a specific hostname was not requested
         #
         if not hostname and not parsable:
-            classads = self.get_classads("OSGRSV==\"consumers\"")
+            classads = snapshot.find("OSGRSV", "consumers")
             running_consumers = []
             if not classads:
                 self.rsv.echo("No consumers are running")
@@ -476,6 +946,71 @@ class Condor:
 
         return True
 
+def build_submit_file(jobs):
+    """ Build a submit file with one Queue statement per job.  Each job is a list of
+    (name, value) pairs. """
+
+    timestamp = strftime("%Y-%m-%d %H:%M:%S %Z")
+
+    submit = ""
+    submit += "######################################################################\n"
+    submit += "# Temporary submit file generated by rsv-control\n"
+    submit += "# Generated at %s\n" % timestamp
+    submit += "######################################################################\n"
+
+    for attributes in jobs:
+        submit += "\n"
+        for (name, value) in attributes:
+            submit += "%s = %s\n" % (name, value)
+        submit += "Queue\n"
+
+    return submit
+
+
+def add_submit_hash(attributes):
+    """ Add +OSGRSVSubmitHash, a hash of the other (name, value) pairs, to a job's
+    attributes.  It lets 'rsv-control --sync' tell whether the job in condor-cron
+    was submitted with the description we would generate now. """
+
+    lines = ["%s = %s" % (name, value) for (name, value) in attributes]
+    submit_hash = md5("\n".join(lines)).hexdigest()
+    attributes.append(("+OSGRSVSubmitHash", "\"%s\"" % submit_hash))
+
+
+def classad_to_dict(ad):
+    """ Convert a ClassAd from the Python bindings into the dict parse_classads
+    would produce for it """
+
+    classad = {}
+    for key in ad.keys():
+        classad[key] = str(ad.lookup(key))
+    return classad
+
+
+def parse_autoformat(output, attributes):
+    """
+    Parse the output of 'condor_cron_q -af:rt <attributes>': one line per job with
+    the values in the order of attributes, separated by tabs.
+    Return an array of hashes like parse_classads.  Undefined values are left out.
+    """
+    classads = []
+    for line in output.split("\n"):
+        if not line.strip():
+            continue
+
+        values = line.split("\t")
+        if len(values) != len(attributes):
+            continue
+
+        classad = {}
+        for index in range(len(attributes)):
+            if values[index] != "undefined":
+                classad[attributes[index]] = values[index]
+        classads.append(classad)
+
+    return classads
+
+
 def parse_classads(output):
     """
     Parse a set of condor classads in "attribute = value" format.
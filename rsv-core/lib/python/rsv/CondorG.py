@@ -2,15 +2,18 @@
 
 import os
 import re
-import pwd
 import sys    # for sys.exit
+import time
 import shutil
 import tempfile
 
 import Condor
+import UserLog
 import Sysutils
 
-KEYWORDS = ["return value", "error", "abort", "Globus job submission failed", "Detected Down Globus Resource", "held"]
+# Lines around the output of each metric in a bundle job
+BUNDLE_BEGIN = "RSV-BUNDLE-BEGIN:"
+BUNDLE_END = "RSV-BUNDLE-END:"
 
 class CondorG:
     """ Interface to submit Condor-G jobs """
@@ -20,20 +23,27 @@ class CondorG:
     out = None
     err = None
     utils = None
+    name = None
     metric = None
+    metrics = None
     tempdir = None
     cleanup = True
     cluster_id = None
 
-    def __init__(self, rsv, cleanup=True):
-        """ Constructor """
+    def __init__(self, rsv, cleanup=True, tempdir=None, log=None):
+        """ Constructor.  If tempdir and log are supplied the job's files are put in
+        tempdir and its events are written to log, which can be shared with other
+        jobs (see GridJobManager).  The directory is then left for its owner to
+        remove. """
         self.rsv = rsv
-        self.cleanup = cleanup
+        self.cleanup = cleanup and tempdir is None
+        self.tempdir = tempdir
+        self.log = log
         self.utils = Sysutils.Sysutils(rsv)
 
     def __del__(self):
         """ Destructor - do filesystem cleanup """
-        if self.cleanup:
+        if self.cleanup and self.tempdir:
             if os.path.exists(self.tempdir):
                 try:
                     shutil.rmtree(self.tempdir)
@@ -41,29 +51,77 @@ class CondorG:
                     self.rsv.log("WARNING", "Could not remove Condor-G temporary directory '%s'.  Error %s" % (self.tempdir, err))
 
 
-    def submit(self, metric, attrs=None, timeout=None):
+    def submit(self, metric, attrs=None, timeout=None, env=None):
         """ Form a grid submit file and submit the job to Condor """
 
+        # env is the job environment built by run_metric.get_job_environment
+        if env is None:
+            env = os.environ
+
         self.metric = metric
+        self.prepare_files(metric)
 
-        # Make a temporary directory to store submit file, input, output, and log
-        parent_dir = os.path.join("/", "var", "tmp", "rsv")
-        if not os.path.exists(parent_dir):
-            # /var/tmp/rsv can be periodically deleted by system cleanup utilities so we sometimes
-            # have to re-create it
-            os.mkdir(parent_dir, 0755)
-            (uid, gid) = pwd.getpwnam('rsv')[2:4]
-            os.chown(parent_dir, uid, gid)
-        self.tempdir = tempfile.mkdtemp(prefix="condor_g-", dir=parent_dir)
-        self.rsv.log("INFO", "Condor-G working directory: %s" % self.tempdir)
-        
-        self.log = os.path.join(self.tempdir, "%s.log" % metric.name)
-        self.out = os.path.join(self.tempdir, "%s.out" % metric.name)
-        self.err = os.path.join(self.tempdir, "%s.err" % metric.name)
+        submit_file = self.get_resource(metric, env)
+        submit_file += "Executable = %s\n" % metric.executable
+
+        args = ['-m', metric.name, '-u', metric.host] + metric.get_args_list()
+        submit_file += "Arguments  = %s\n" % quote_arguments(args)
+
+        # Add in custom attributes
+        if attrs:
+            for key in attrs.keys():
+                submit_file += "%s = %s\n" % (key, attrs[key])
+
+        transfer_files = metric.get_transfer_files()
+        if transfer_files:
+            submit_file += "transfer_input_files = %s\n" % ", ".join(transfer_files)
+
+        return self.submit_description(submit_file, env)
+
+
+    def submit_bundle(self, metrics, attrs=None, env=None):
+        """ Submit a single grid job that runs several metrics against the same host
+        one after the other (see make_bundle_script).  The metrics must all use the
+        same grid resource (see get_resource). """
+
+        if env is None:
+            env = os.environ
+
+        self.metric = metrics[0]
+        self.metrics = metrics
+        self.prepare_files(metrics[0], "%s__bundle" % metrics[0].host)
+
+        script = os.path.join(self.tempdir, "%s.sh" % self.name)
+        try:
+            script_fp = open(script, 'w')
+            script_fp.write(make_bundle_script(self.rsv, metrics))
+            script_fp.close()
+            os.chmod(script, 0755)
+        except (IOError, OSError), err:
+            self.rsv.log("ERROR", "Cannot write bundle script '%s': %s" % (script, err))
+            return False
+
+        submit_file = self.get_resource(self.metric, env)
+        submit_file += "Executable = %s\n" % script
+
+        if attrs:
+            for key in attrs.keys():
+                submit_file += "%s = %s\n" % (key, attrs[key])
+
+        transfer_files = []
+        for metric in metrics:
+            for path in [metric.executable] + (metric.get_transfer_files() or []):
+                if path not in transfer_files:
+                    transfer_files.append(path)
+        submit_file += "transfer_input_files = %s\n" % ", ".join(transfer_files)
+
+        self.rsv.log("INFO", "Submitting %s metrics against host %s in one job" % (len(metrics), self.metric.host))
+        return self.submit_description(submit_file, env)
+
+
+    def get_resource(self, metric, env):
+        """ Return the part of the submit file that says where the job runs """
 
-        #
-        # Build the submit file
-        #
         ce_type = (  metric.config_get("ce-type")
                   or metric.config_get("gatekeeper-type")
                   or getattr(metric, "ce-type", None)
@@ -110,23 +168,15 @@ class CondorG:
             submit_file += "grid_resource = gt2 %s/jobmanager-%s\n\n" % (metric.host, jobmanager)
         
         # The user proxy should be in the submit file regardless of the CE type
-        if 'X509_USER_PROXY' in os.environ:
-                submit_file += "x509userproxy = %s\n" % os.environ['X509_USER_PROXY']
+        if 'X509_USER_PROXY' in env:
+                submit_file += "x509userproxy = %s\n" % env['X509_USER_PROXY']
 
-        submit_file += "Executable = %s\n" % metric.executable
+        return submit_file
 
-        args = ['-m', metric.name, '-u', metric.host] + metric.get_args_list()
-        submit_file += "Arguments  = %s\n" % quote_arguments(args)
 
-        # Add in custom attributes
-        if attrs:
-            for key in attrs.keys():
-                submit_file += "%s = %s\n" % (key, attrs[key])
+    def submit_description(self, submit_file, env):
+        """ Add the output settings to a submit file and submit the job to Condor """
 
-        transfer_files = metric.get_transfer_files()
-        if transfer_files:
-            submit_file += "transfer_input_files = %s\n" % ", ".join(transfer_files)
-            
         submit_file += "Log = %s\n" % self.log
         submit_file += "Output = %s\n" % self.out
         submit_file += "Error = %s\n\n" % self.err
@@ -135,45 +185,55 @@ class CondorG:
         submit_file += "Queue\n"
 
         condor = Condor.Condor(self.rsv)
-        self.cluster_id = condor.submit_job(submit_file, metric.name, dir=self.tempdir, remove=0)
+        self.cluster_id = condor.submit_job(submit_file, self.name, dir=self.tempdir, remove=0, env=env)
 
         if not self.cluster_id:
             return False
 
         self.rsv.log("DEBUG", "Condor-G submission job ID - %s" % self.cluster_id)
         return True
-        
+
+
+    def prepare_files(self, metric, name=None):
+        """ Choose the paths of the submit file, output, and log for the job """
+
+        if self.tempdir:
+            # The directory is shared with jobs for other hosts
+            self.name = name or metric.get_unique_name()
+        else:
+            # Make a temporary directory to store submit file, input, output, and log
+            self.name = metric.name
+            self.tempdir = tempfile.mkdtemp(prefix="condor_g-", dir=get_work_parent_dir(self.rsv))
+            self.rsv.log("INFO", "Condor-G working directory: %s" % self.tempdir)
+
+        if not self.log:
+            self.log = os.path.join(self.tempdir, "%s.log" % self.name)
+        self.out = os.path.join(self.tempdir, "%s.out" % self.name)
+        self.err = os.path.join(self.tempdir, "%s.err" % self.name)
+
 
     def wait(self):
         """ Wait for the job to complete """
         
         # Monitor the job's log and watch for it to finish
-        job_timeout = self.metric.get_timeout() or self.rsv.config.get("rsv", "job-timeout")
+        job_timeout = self.metric.get_timeout() or self.rsv.config.getint("rsv", "job-timeout")
 
+        # Only the wall time is known for jobs that run under Condor
+        start_time = time.time()
         try:
-            (keyword, log_contents) = self.utils.watch_log(self.log, KEYWORDS, job_timeout)
-        except Sysutils.TimeoutError, err:
-            self.remove()
-            return 5
-
-        if keyword == "return value":
-            return 0
-        elif keyword == "abort":
-            return 1
-        elif keyword == "error":
-            return 2
-        elif keyword == "Globus job submission failed":
+            event = UserLog.UserLog(self.rsv, self.log).wait(self.cluster_id, job_timeout)
+        except Sysutils.TimeoutError:
+            self.metric.performance = Sysutils.ResourceUsage(time.time() - start_time, timed_out=True)
             self.remove()
-            return 3
-        elif keyword == "Detected Down Globus Resource":
-            self.remove()
-            return 4
-        elif keyword == "held":
+            return UserLog.TIMED_OUT
+
+        self.metric.performance = Sysutils.ResourceUsage(time.time() - start_time)
+
+        outcome = event.get_outcome()
+        if outcome in (UserLog.SUBMISSION_FAILED, UserLog.RESOURCE_DOWN, UserLog.HELD):
             self.remove()
-            return 6
 
-        # We should not reach here, but just in case
-        return False
+        return outcome
         
 
     def remove(self):
@@ -190,16 +250,124 @@ class CondorG:
 
 
     def get_stdout(self):
-        """ Return the STDOUT of the job """
-        return self.utils.slurp(self.out)
+        """ Return the STDOUT of the job (trimmed in the middle if it is very large) """
+        limit = self.rsv.get_capture_limit()
+        if self.metrics:
+            limit *= len(self.metrics)
+        return self.utils.slurp_bounded(self.out, limit)
+
+    def get_bundle_outputs(self):
+        """ Return the output of each metric in a bundle job (see split_bundle_output).
+        The capture limit applies to each metric's output separately. """
+        try:
+            out_fp = open(self.out, 'r')
+        except IOError, err:
+            self.rsv.log("WARNING", "Could not read output of bundle job: %s" % err)
+            return {}
+
+        try:
+            return split_bundle_output(out_fp, self.rsv.get_capture_limit())
+        finally:
+            out_fp.close()
 
     def get_stderr(self):
-        """ Return the STDERR of the job """
-        return self.utils.slurp(self.err)
+        """ Return the STDERR of the job (trimmed in the middle if it is very large) """
+        return self.utils.slurp_bounded(self.err, self.rsv.get_capture_limit())
 
     def get_log_contents(self):
-        """ Return the log contents of the job """
-        return self.utils.slurp(self.log)
+        """ Return the log contents of the job.  For a shared log only the job's
+        own events are returned. """
+        if self.cleanup:
+            return self.utils.slurp(self.log)
+        return UserLog.get_job_text(self.rsv, self.log, self.cluster_id)
+
+
+def make_bundle_script(rsv, metrics):
+    """ Return a shell script that runs each metric in turn with its own arguments
+    and environment.  The output of each metric is written between markers that
+    split_bundle_output recognizes. """
+
+    script = "#!/bin/sh\n"
+    script += "# Generated by rsv-control to run several RSV metrics in one grid job\n"
+
+    for metric in metrics:
+        executable = os.path.basename(metric.executable)
+        args = ['-m', metric.name, '-u', metric.host] + metric.get_args_list()
+
+        script += "\necho %s\n" % shell_quote("%s %s" % (BUNDLE_BEGIN, metric.name))
+        script += "start=`date +%s`\n"
+        script += "(\n"
+
+        env = metric.get_environment() or {}
+        for var in env.keys():
+            if not re.match(r"^[A-Za-z_][A-Za-z0-9_]*$", var):
+                rsv.log("WARNING", "Not setting invalid environment variable name '%s' for metric %s" %
+                        (var, metric.name))
+                continue
+            (action, value) = env[var]
+            action = action.upper()
+            if action == "SET":
+                script += "  %s=%s; export %s\n" % (var, shell_quote(value), var)
+            elif action == "APPEND":
+                script += "  %s=\"${%s:+$%s:}\"%s; export %s\n" % (var, var, var, shell_quote(value), var)
+            elif action == "PREPEND":
+                script += "  %s=%s\"${%s:+:$%s}\"; export %s\n" % (var, shell_quote(value), var, var, var)
+            elif action == "UNSET":
+                script += "  unset %s\n" % var
+
+        script += "  chmod 755 ./%s 2>/dev/null\n" % shell_quote(executable)
+        script += "  exec ./%s %s\n" % (shell_quote(executable), " ".join([shell_quote(arg) for arg in args]))
+        script += ") > rsv-bundle.out\n"
+        script += "ret=$?\n"
+        script += "cat rsv-bundle.out\n"
+        script += "echo\n"
+        script += "echo \"%s %s $ret $((`date +%%s` - start))\"\n" % (BUNDLE_END, metric.name)
+
+    script += "\nrm -f rsv-bundle.out\nexit 0\n"
+    return script
+
+
+def split_bundle_output(lines, limit=0):
+    """ Split the output of a bundle job, given as an iterable of lines, into a
+    dictionary of metric name -> (exit code, seconds, output).  Each output is
+    collected in its own Sysutils.OutputBuffer with the given limit, so one metric
+    with a lot of output cannot hide the markers of the others. """
+
+    results = {}
+    name = None
+    buffer = None
+    for line in lines:
+        if line.startswith(BUNDLE_BEGIN + " "):
+            name = line[len(BUNDLE_BEGIN) + 1:].strip()
+            buffer = Sysutils.OutputBuffer(limit)
+            continue
+
+        if name is not None and line.startswith("%s %s " % (BUNDLE_END, name)):
+            fields = line.split()
+            if len(fields) == 4 and fields[2].isdigit() and fields[3].isdigit():
+                buffer.close()
+                # The script prints a newline after the output so that the end marker
+                # starts a line of its own
+                output = buffer.getvalue()
+                if output.endswith("\n"):
+                    output = output[:-1]
+                results[name] = (int(fields[2]), int(fields[3]), output)
+                name = None
+                buffer = None
+                continue
+
+        if buffer is not None:
+            buffer.write(line)
+
+    if buffer is not None:
+        buffer.close()
+
+    return results
+
+
+def shell_quote(value):
+    """ Quote a value for /bin/sh """
+    return "'" + value.replace("'", "'\\''") + "'"
 
 
 def quote_arguments(args):
@@ -217,3 +385,15 @@ def quote_arguments(args):
 
     return ' '.join(quote_arg(arg) for arg in args)
 
+
+def get_work_parent_dir(rsv):
+    """ Return the directory to create job working directories in.  This is
+    /var/tmp/rsv unless it cannot be used safely, in which case it is the
+    system's temporary directory. """
+
+    if Sysutils.make_rsv_dir(Sysutils.RSV_TMP_DIR):
+        return Sysutils.RSV_TMP_DIR
+
+    rsv.log("WARNING", "'%s' could not be created or is not owned by root or rsv.  Using '%s' instead." %
+            (Sysutils.RSV_TMP_DIR, tempfile.gettempdir()))
+    return None
@@ -2,7 +2,6 @@
 
 """ This class is basically the same as CondorG but to submit Vanilla jobs """
 import os
-import tempfile
 import Condor
 from CondorG import CondorG
 import CondorG as libCondorG
@@ -11,33 +10,23 @@ import CondorG as libCondorG
 class CondorVanilla(CondorG):
 
 
-      def submit(self, metric, attrs=None, timeout=None):
+      def submit(self, metric, attrs=None, timeout=None, env=None):
         """ Form a grid submit file and submit the job to Condor """
 
-        self.metric = metric
+        # env is the job environment built by run_metric.get_job_environment
+        if env is None:
+            env = os.environ
 
-        # Make a temporary directory to store submit file, input, output, and log
-        parent_dir = os.path.join("/", "var", "tmp", "rsv")
-        if not os.path.exists(parent_dir):
-            # /var/tmp/rsv can be periodically deleted by system cleanup utilities so we sometimes
-            # have to re-create it
-            os.mkdir(parent_dir, 0755)
-            (uid, gid) = pwd.getpwnam('rsv')[2:4]
-            os.chown(parent_dir, uid, gid)
-        self.tempdir = tempfile.mkdtemp(prefix="condor_g-", dir=parent_dir)
-        self.rsv.log("INFO", "Condor-G working directory: %s" % self.tempdir)
-        
-        self.log = os.path.join(self.tempdir, "%s.log" % metric.name)
-        self.out = os.path.join(self.tempdir, "%s.out" % metric.name)
-        self.err = os.path.join(self.tempdir, "%s.err" % metric.name)
+        self.metric = metric
+        self.prepare_files(metric)
 
         #
         # Build the submit file
         #
         submit_file = "Universe = Vanilla\n"
         # The user proxy should be in the submit file regardless of the CE type
-        if 'X509_USER_PROXY' in os.environ:
-                submit_file += "x509userproxy = %s\n" % os.environ['X509_USER_PROXY']
+        if 'X509_USER_PROXY' in env:
+                submit_file += "x509userproxy = %s\n" % env['X509_USER_PROXY']
         submit_file += "Executable = %s\n" % metric.executable
         args = ['-m', metric.name, '-u', metric.host] + metric.get_args_list()
         submit_file += "Arguments  = %s\n" % libCondorG.quote_arguments(args)
@@ -66,7 +55,7 @@ class CondorVanilla(CondorG):
         submit_file += "Queue\n"
 
         condor = Condor.Condor(self.rsv)
-        self.cluster_id = condor.submit_job(submit_file, metric.name, dir=self.tempdir, remove=0)
+        self.cluster_id = condor.submit_job(submit_file, self.name, dir=self.tempdir, remove=0, env=env)
 
         if not self.cluster_id:
             return False
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import os
+import re
+import atexit
+import ConfigParser
+
+# RSV libraries
+import StateFile
+
+# The cache shared by everything in this process (see get_cache)
+_cache = None
+
+# The configuration that does not belong to a host is kept in this state file.
+# Each host has its own, named SHARD_PREFIX + the host name.
+GLOBAL_SHARD = "config"
+SHARD_PREFIX = "config-"
+
+
+class ConfigCache:
+    """ The merged contents of the INI files behind the RSV, Metric, Host and
+    Consumer configuration, so that the files are only parsed again after one of
+    them changes.  Each entry is stored with a signature made of the mtime, size
+    and inode of its files plus the built-in defaults it was merged with.
+
+    The entries for a host (its Host and its Metrics) are kept in a state file of
+    their own, so a run against one host only reads that host's entries.  Each
+    file is read at most once per process and new entries are written back
+    together when the process exits. """
+
+    def __init__(self, rsv):
+        self.rsv = rsv
+
+        # Entries by shard and then by key, as read from disk
+        self.shards = {}
+
+        # Entries to write back, by shard and then by key
+        self.changes = {}
+
+
+    def get_signature(self, files, defaults=None):
+        """ Return the signature of a configuration built from files and defaults """
+
+        signature = []
+        for path in files:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime, stat.st_size, stat.st_ino))
+            except OSError:
+                signature.append((path, None, None, None))
+
+        return (signature, defaults or {})
+
+
+    def get_entries(self, shard):
+        """ Return the entries in a shard, reading it if this is the first use """
+        if shard not in self.shards:
+            self.shards[shard] = StateFile.StateFile(self.rsv, shard).read()
+        return self.shards[shard]
+
+
+    def get(self, key, signature, host=None):
+        """ Return a RawConfigParser with the configuration stored for key, or None
+        if there is no entry or it was stored with a different signature.  host is
+        the host the configuration belongs to, if any. """
+
+        entry = self.get_entries(get_shard(host)).get(key)
+        if entry is None:
+            return None
+
+        (timestamp, (stored_signature, data)) = entry
+        if stored_signature != signature:
+            self.rsv.log("DEBUG", "Cached configuration for '%s' is out of date" % key)
+            return None
+
+        self.rsv.log("INFO", "Using cached configuration for '%s'" % key)
+        return load_config(data)
+
+
+    def set(self, key, signature, config, host=None):
+        """ Store the configuration in config (a RawConfigParser) for key """
+
+        shard = get_shard(host)
+        entries = self.get_entries(shard)
+
+        if not self.changes:
+            atexit.register(self.flush)
+
+        value = (signature, dump_config(config))
+        self.changes.setdefault(shard, {})[key] = value
+        entries[key] = (None, value)
+
+
+    def flush(self):
+        """ Write the new entries to disk.  Entries for metrics and consumers that
+        are no longer installed and the shards of hosts that are no longer
+        configured are removed at the same time. """
+
+        if not self.changes:
+            return
+
+        installed = {}
+        for name in self.rsv.get_installed_metrics():
+            installed["metric " + name] = 1
+        for name in self.rsv.get_installed_consumers():
+            installed["consumer " + name] = 1
+
+        for shard in self.changes.keys():
+            changes = self.changes[shard]
+            for key in self.shards[shard].keys():
+                words = key.split()
+                if key not in changes and words[0] in ("metric", "consumer") and \
+                       " ".join(words[:2]) not in installed:
+                    changes[key] = None
+
+            self.rsv.log("DEBUG", "Saving %s configuration cache entries in '%s'" % (len(changes), shard))
+            StateFile.StateFile(self.rsv, shard).update(changes)
+
+        self.changes = {}
+        self.prune_shards()
+
+
+    def prune_shards(self):
+        """ Remove the shards of hosts that do not have a config file any more """
+
+        hosts = {}
+        for host in self.rsv.get_hosts() or []:
+            hosts[get_shard(host)] = 1
+
+        try:
+            names = os.listdir(StateFile.STATE_DIR)
+        except OSError:
+            return
+
+        for name in names:
+            match = re.match(r"^(%s.+)\.state$" % re.escape(SHARD_PREFIX), name)
+            if match and match.group(1) not in hosts:
+                self.rsv.log("DEBUG", "Removing configuration cache '%s'" % name)
+                StateFile.StateFile(self.rsv, match.group(1)).remove()
+
+
+def get_cache(rsv):
+    """ Return the configuration cache for this process """
+    global _cache
+    if _cache is None:
+        _cache = ConfigCache(rsv)
+    return _cache
+
+
+def get_shard(host):
+    """ Return the name of the state file for the configuration of host (or for
+    the configuration that does not belong to a host if host is None) """
+    if not host:
+        return GLOBAL_SHARD
+    return SHARD_PREFIX + re.sub(r"[^\w.:-]", "_", host)
+
+
+def dump_config(config):
+    """ Return the contents of a RawConfigParser using only types that marshal
+    can store """
+
+    defaults = config.defaults()
+    sections = []
+    for section in config.sections():
+        options = []
+        for option in config.options(section):
+            value = config.get(section, option)
+            # options() includes the [DEFAULT] section, which is stored separately
+            if option in defaults and defaults[option] == value:
+                continue
+            options.append((option, value))
+        sections.append((section, options))
+
+    return (defaults.items(), sections)
+
+
+def load_config(data):
+    """ Build a RawConfigParser from the output of dump_config """
+
+    (defaults, sections) = data
+
+    config = ConfigParser.RawConfigParser()
+    config.optionxform = str # make keys case-sensitive
+    for (option, value) in defaults:
+        config.set(ConfigParser.DEFAULTSECT, option, value)
+    for (section, options) in sections:
+        config.add_section(section)
+        for (option, value) in options:
+            config.set(section, option, value)
+
+    return config
@@ -4,6 +4,8 @@ import os
 import sys
 import ConfigParser
 
+import ConfigCache
+
 class Consumer:
     """ Instantiable class to read and store configuration about a single consumer """
     
@@ -22,9 +24,16 @@ class Consumer:
 
         # Load configuration
         defaults = get_consumer_defaults(consumer)
-        self.config = ConfigParser.RawConfigParser()
-        self.config.optionxform = str # make keys case-insensitive
-        self.load_config(defaults)
+        cache = ConfigCache.get_cache(rsv)
+        config_files = [os.path.join(self.meta_dir, consumer + ".meta"),
+                        os.path.join(self.conf_dir, consumer + ".conf")]
+        signature = cache.get_signature(config_files, defaults)
+        self.config = cache.get("consumer " + consumer, signature)
+        if self.config is None:
+            self.config = ConfigParser.RawConfigParser()
+            self.config.optionxform = str # make keys case-insensitive
+            self.load_config(defaults)
+            cache.set("consumer " + consumer, signature, self.config)
 
 
     def load_config(self, defaults):
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import re
+
+# RSV libraries
+import StateFile
+
+# A prerequisite with any other status is considered to have failed
+PASSING_STATUSES = ["OK", "WARNING"]
+
+# The metrics other metrics depend on, by host (see get_prerequisites)
+_prerequisites = {}
+
+class Dependencies:
+    """ Track the latest status of each metric against each host so that metrics
+    which declare 'depends-on' in their meta file can be skipped when one of their
+    prerequisites is failing.  The statuses are shared with other rsv-control
+    processes (condor-cron jobs, --jobs workers) for dependency-status-ttl seconds. """
+
+    def __init__(self, rsv):
+        self.rsv = rsv
+        self.ttl = rsv.get_dependency_status_ttl()
+        self.state = StateFile.StateFile(rsv, "metric-status")
+
+
+    def record(self, metric, record):
+        """ Remember the status found in a result record for a metric, if another
+        metric depends on it """
+
+        if not metric.host or self.ttl <= 0 or self.rsv.options.test:
+            return
+
+        match = re.search("^metricStatus: (\w+)", record, re.MULTILINE)
+        if not match:
+            return
+
+        # wlcg-multiple metrics produce records for other metric names
+        name = metric.name
+        name_match = re.search("^metricName: (\S+)", record, re.MULTILINE)
+        if name_match:
+            name = name_match.group(1)
+
+        if name not in get_prerequisites(self.rsv, metric.host):
+            return
+
+        self.state.set(get_key(metric.host, name), match.group(1).upper())
+
+
+    def get_failed_prerequisite(self, metric):
+        """ Return (prerequisite, status) for the first prerequisite of the metric whose
+        latest status against the same host is failing, or None if the metric can run.
+        A prerequisite with no recent status does not stop the metric from running. """
+
+        for prerequisite in metric.get_dependencies():
+            status = self.state.get(get_key(metric.host, prerequisite), self.ttl)
+            if status and status not in PASSING_STATUSES:
+                self.rsv.log("INFO", "Prerequisite %s of metric %s has status %s against host %s" %
+                             (prerequisite, metric.name, status, metric.host))
+                return (prerequisite, status)
+
+        return None
+
+
+def get_prerequisites(rsv, host):
+    """ Return a dictionary of the names of the metrics that installed metrics
+    depend on when run against host.  This is only worked out once per host. """
+
+    if host not in _prerequisites:
+        prerequisites = {}
+        for name in rsv.get_installed_metrics():
+            for prerequisite in rsv.get_metric(name, host).get_dependencies():
+                prerequisites[prerequisite] = 1
+        _prerequisites[host] = prerequisites
+
+    return _prerequisites[host]
+
+
+def get_key(host, metric_name):
+    """ Key used in the state file """
+    return "%s %s" % (host, metric_name)
+
+
+def order_metrics(rsv, metrics):
+    """ Return the metrics (all against the same host) ordered so that each metric
+    comes after the metrics it depends on.  Otherwise the original order is kept.
+    Dependency cycles are reported and broken. """
+
+    by_name = {}
+    for metric in metrics:
+        by_name[metric.name] = metric
+
+    ordered = []
+    done = {}
+    visiting = {}
+
+    def visit(metric):
+        if id(metric) in done:
+            return
+        if metric.name in visiting:
+            rsv.log("WARNING", "Metric %s is part of a dependency cycle.  Its dependencies will be ignored." %
+                    metric.name)
+            return
+
+        visiting[metric.name] = 1
+        for prerequisite in metric.get_dependencies():
+            if prerequisite in by_name:
+                visit(by_name[prerequisite])
+        del visiting[metric.name]
+
+        done[id(metric)] = 1
+        ordered.append(metric)
+
+    for metric in metrics:
+        visit(metric)
+
+    return ordered
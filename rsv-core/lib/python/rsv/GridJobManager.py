@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import os
+import time
+import shutil
+import tempfile
+
+# RSV libraries
+import CondorG
+import UserLog
+import Sysutils
+
+
+class GridJob:
+    """ A Condor-G or Vanilla job submitted through a GridJobManager.  A bundle job
+    runs several metrics, each with its own label. """
+
+    def __init__(self, metrics, job, labels):
+        self.metrics = metrics
+        self.job = job
+        self.labels = labels
+        self.outcome = None
+
+        # A bundle job has as long as its metrics would have had together
+        timeout = 0
+        for metric in metrics:
+            timeout += metric.get_timeout() or metric.rsv.config.getint("rsv", "job-timeout")
+        self.start_time = time.time()
+        self.end_time = self.start_time + timeout
+
+
+    def is_bundle(self):
+        """ Return True if the job runs more than one metric """
+        return self.job.metrics is not None
+
+
+class GridJobManager:
+    """ Submit the Condor-G and Vanilla jobs for many metrics and wait for all of
+    them at once.  The jobs share one working directory and one user log, and a
+    single watcher hands each final event to the job with the same cluster ID. """
+
+    def __init__(self, rsv):
+        self.rsv = rsv
+        self.tempdir = None
+        self.log = None
+        self.userlog = None
+
+        # Jobs that have not finished, by cluster ID
+        self.running = {}
+
+
+    def __del__(self):
+        """ Destructor - do filesystem cleanup """
+        if self.tempdir and os.path.exists(self.tempdir):
+            try:
+                shutil.rmtree(self.tempdir)
+            except OSError, err:
+                self.rsv.log("WARNING", "Could not remove grid job directory '%s'.  Error %s" % (self.tempdir, err))
+
+
+    def new_job(self, job_class):
+        """ Return a new CondorG (or CondorVanilla) object that uses the shared
+        directory and log """
+
+        if not self.tempdir:
+            self.tempdir = tempfile.mkdtemp(prefix="grid_jobs-", dir=CondorG.get_work_parent_dir(self.rsv))
+            self.log = os.path.join(self.tempdir, "jobs.log")
+            self.userlog = UserLog.UserLog(self.rsv, self.log)
+            self.rsv.log("INFO", "Grid job working directory: %s" % self.tempdir)
+
+        return job_class(self.rsv, tempdir=self.tempdir, log=self.log)
+
+
+    def add(self, metrics, job, labels):
+        """ Start waiting for a job that has been submitted for the metrics (one
+        metric unless the job is a bundle) """
+        names = " ".join([metric.name for metric in metrics])
+        self.rsv.log("INFO", "Waiting for job %s (%s against host %s) in the background" %
+                     (job.cluster_id, names, metrics[0].host))
+        self.running[str(job.cluster_id)] = GridJob(metrics, job, labels)
+
+
+    def is_running(self, host, metric_names):
+        """ Return True if a job for any of the metrics against host has not finished """
+        for grid_job in self.running.values():
+            for metric in grid_job.metrics:
+                if metric.host == host and metric.name in metric_names:
+                    return True
+        return False
+
+
+    def cancel_host(self, host):
+        """ Remove the unfinished jobs against host from Condor and stop waiting for
+        them.  Returns the GridJobs that were removed, in the order they were
+        submitted. """
+
+        cancelled = []
+        for cluster_id in self.running.keys():
+            grid_job = self.running[cluster_id]
+            if grid_job.metrics[0].host == host:
+                del self.running[cluster_id]
+                grid_job.job.remove()
+                cancelled.append(grid_job)
+
+        if cancelled:
+            self.rsv.log("INFO", "Removed %s grid jobs against host %s" % (len(cancelled), host))
+        cancelled.sort(key=lambda grid_job: grid_job.start_time)
+        return cancelled
+
+
+    def poll(self, handler):
+        """ Pass each job that has finished since the last call to handler, without
+        waiting for the others (see wait_all) """
+
+        if not self.running:
+            return
+
+        for event in self.userlog.read_events():
+            grid_job = self.running.get(event.cluster_id)
+            if grid_job is None or event.get_outcome() is None:
+                continue
+            del self.running[event.cluster_id]
+            self.finish(grid_job, event.get_outcome(), handler)
+
+
+    def wait_all(self, handler, deadline=None):
+        """ Wait for every job to finish.  handler is called with each GridJob as
+        soon as it finishes, with its outcome set to the value CondorG.wait would
+        have returned.  handler may cancel other jobs (see cancel_host).  Jobs that
+        have not finished by deadline (a time) are treated as timed out. """
+
+        if not self.running:
+            return
+
+        self.rsv.log("INFO", "Waiting for %s grid jobs" % len(self.running))
+
+        watcher = UserLog.LogWatcher(self.rsv, self.log)
+        try:
+            while self.running:
+                self.poll(handler)
+
+                now = time.time()
+                end_time = None
+                for cluster_id in self.running.keys():
+                    grid_job = self.running.get(cluster_id)
+                    if grid_job is None:
+                        # Cancelled by the handler of another job
+                        continue
+                    job_end_time = grid_job.end_time
+                    if deadline is not None and deadline < job_end_time:
+                        job_end_time = deadline
+                    if job_end_time <= now:
+                        del self.running[cluster_id]
+                        self.finish(grid_job, UserLog.TIMED_OUT, handler)
+                    elif end_time is None or job_end_time < end_time:
+                        end_time = job_end_time
+
+                if end_time is not None:
+                    watcher.wait(end_time - now)
+        finally:
+            watcher.close()
+
+
+    def finish(self, grid_job, outcome, handler):
+        """ Clean up after a finished job and pass it to the handler """
+
+        timed_out = outcome == UserLog.TIMED_OUT
+        for metric in grid_job.metrics:
+            metric.performance = Sysutils.ResourceUsage(time.time() - grid_job.start_time, timed_out=timed_out)
+
+        if outcome in (UserLog.SUBMISSION_FAILED, UserLog.RESOURCE_DOWN, UserLog.HELD, UserLog.TIMED_OUT):
+            grid_job.job.remove()
+
+        grid_job.outcome = outcome
+        handler(grid_job)
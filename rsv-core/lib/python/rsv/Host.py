@@ -4,6 +4,9 @@ import os
 import sys
 import ConfigParser
 
+import Sysutils
+import ConfigCache
+
 class Host:
     """ Instantiable class to read and store configuration about a single host """
 
@@ -13,15 +16,20 @@ class Host:
         self.conf_dir = os.path.join("/", "etc", "rsv")
 
         # Load configuration
-        self.config = ConfigParser.RawConfigParser()
-        self.config.optionxform = str  # Make keys case-sensitive
-        self.load_config()
+        self.config_file = os.path.join(self.conf_dir, self.host + ".conf")
+        cache = ConfigCache.get_cache(rsv)
+        signature = cache.get_signature([self.config_file])
+        self.config = cache.get("host " + host, signature, host)
+        if self.config is None:
+            self.config = ConfigParser.RawConfigParser()
+            self.config.optionxform = str  # Make keys case-sensitive
+            self.load_config()
+            cache.set("host " + host, signature, self.config, host)
 
 
     def load_config(self):
         """ Load host specific configuration file """
 
-        self.config_file = os.path.join(self.conf_dir, self.host + ".conf")
         if not os.path.exists(self.config_file):
             self.rsv.log("INFO", "Host config file '%s' does not exist" % self.config_file)
         else:
@@ -59,6 +67,39 @@ class Host:
         return enabled_metrics
 
 
+    def get_max_concurrent_metrics(self):
+        """ Return the maximum number of metrics that may run against this host at
+        the same time, or 0 for no limit.  This is read from the '<host> settings'
+        section of the host config file so that it is not mistaken for a metric,
+        and falls back to max-concurrent-metrics-per-host in rsv.conf. """
+
+        section = self.host + " settings"
+        try:
+            limit = self.config.getint(section, "max-concurrent-metrics")
+            if limit >= 0:
+                return limit
+            self.rsv.log("WARNING", "A negative value is set for max-concurrent-metrics for host '%s'" %
+                         self.host)
+            return 0
+        except ValueError:
+            self.rsv.log("WARNING", "A non-integer value is set for max-concurrent-metrics for host '%s'" %
+                         self.host)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            pass
+
+        try:
+            limit = self.rsv.config.getint("rsv", "max-concurrent-metrics-per-host")
+            if limit >= 0:
+                return limit
+            self.rsv.log("WARNING", "A negative value is set for max-concurrent-metrics-per-host in rsv.conf")
+        except ValueError:
+            self.rsv.log("WARNING", "A non-integer value is set for max-concurrent-metrics-per-host in rsv.conf")
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            pass
+
+        return 0
+
+
     def set_config(self, option, value, write_file=False):
         """ Set a value in the host configuration dict. """
 
@@ -73,6 +114,4 @@ class Host:
         if not os.path.exists(self.config_file):
             self.rsv.echo("Creating configuration file '%s'" % self.config_file)
             
-        config_fp = open(self.config_file, 'w')
-        self.config.write(config_fp)
-        config_fp.close()
+        Sysutils.write_config(self.config, self.config_file)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import os
+import re
+import time
+
+# RSV libraries
+import StateFile
+
+# A --jobs run passes its run ID to its workers in this environment variable
+RUN_ID_VARIABLE = "RSV_RUN_ID"
+
+# Shared state left behind by runs that were killed is removed after this many seconds
+STALE_RUN_AGE = 24 * 60 * 60
+
+class HostGate:
+    """ Keep track of hosts that have been found to be unreachable, either because
+    they did not answer a ping or because a grid submission reported that the
+    remote gatekeeper is down.  Once a host is marked down the remaining metrics
+    against it in this run are not run.
+
+    Nothing is remembered between runs.  If run_id is supplied the state is shared
+    with the other processes of the same run (a --jobs parent and its workers). """
+
+    def __init__(self, rsv, run_id=None):
+        self.rsv = rsv
+        self.run_id = run_id
+        self.state = None
+        if run_id:
+            self.state = StateFile.StateFile(rsv, "hosts-" + run_id)
+        self.down = {}
+
+
+    def mark_down(self, host, reason, ping=False):
+        """ Declare a host unreachable.  ping is True if the host was declared down
+        because it did not answer a ping. """
+        self.rsv.log("WARNING", "Host %s is unreachable.  Remaining metrics against it will not be run." % host)
+        self.down[host] = (reason, ping)
+        if self.state:
+            self.state.set(host, (reason, ping))
+
+
+    def get_reason(self, host, ignore_ping=False):
+        """ Return the reason the host was declared down, or None if it is not down.
+        If ignore_ping is True a host that only failed a ping is not down. """
+
+        entry = self.down.get(host)
+        if entry is None and self.state:
+            entry = self.state.get(host)
+            if entry:
+                self.down[host] = entry
+
+        if not entry:
+            return None
+
+        (reason, ping) = entry
+        if ping and ignore_ping:
+            self.rsv.log("DEBUG", "Ignoring failed ping of host %s because ping checks are disabled" % host)
+            return None
+        return reason
+
+
+    def close(self):
+        """ Remove the shared state once the run is over """
+        if self.state:
+            self.state.remove()
+
+
+def get_gate(rsv, shared):
+    """ Return the HostGate for this process.  If shared is True a new run is
+    started whose state can be passed to workers (see RUN_ID_VARIABLE).
+    Otherwise the gate of the run we are a worker of is used, if any. """
+
+    if shared:
+        prune_stale_runs(rsv)
+        return HostGate(rsv, "%s-%s" % (int(time.time()), os.getpid()))
+
+    run_id = os.environ.get(RUN_ID_VARIABLE)
+    if run_id and re.match(r"^\d+-\d+$", run_id):
+        return HostGate(rsv, run_id)
+    return HostGate(rsv)
+
+
+def prune_stale_runs(rsv):
+    """ Remove the shared state of runs that did not clean up after themselves """
+
+    try:
+        names = os.listdir(StateFile.STATE_DIR)
+    except OSError:
+        return
+
+    cutoff = time.time() - STALE_RUN_AGE
+    for name in names:
+        match = re.match(r"^hosts-(\d+)-\d+\.state$", name)
+        if match and int(match.group(1)) < cutoff:
+            rsv.log("DEBUG", "Removing host state of an old run: '%s'" % name)
+            StateFile.StateFile(rsv, name[:-len(".state")]).remove()
@@ -5,8 +5,15 @@ import re
 import sys
 import ConfigParser
 
+import Sysutils
+import ConfigCache
+
 VALID_OUTPUT_FORMATS = ["wlcg", "wlcg-multiple", "brief"]
 
+# The usable sections of each allmetrics.conf file read by this process, by path
+# (see get_allmetrics_sections)
+_allmetrics_sections = {}
+
 class Metric:
     """ Instantiable class to read and store configuration for a single metric """
 
@@ -32,14 +39,28 @@ class Metric:
         self.host = None
         if host:
             self.host = host
-            self.host_config_file = os.path.join(conf_dir, host, metric + ".conf")
+            self.host_config_file = get_host_config_file(metric, host)
             self.host_allmetrics_config_file = os.path.join(conf_dir, host, "allmetrics.conf")
 
-        # Load configuration
+        # Load configuration.  The cache is not used when a config file is given
+        # on the command line.
         defaults = get_metric_defaults(metric)
-        self.config = ConfigParser.RawConfigParser()
-        self.config.optionxform = str
-        self.load_config(defaults, options)
+        cache = ConfigCache.get_cache(rsv)
+        cache_key = "metric " + metric
+        if host:
+            cache_key += " " + host
+        signature = cache.get_signature(self.get_config_files(), defaults)
+        use_cache = not (options and options.extra_config_file)
+
+        self.config = None
+        if use_cache:
+            self.config = cache.get(cache_key, signature, host)
+        if self.config is None:
+            self.config = ConfigParser.RawConfigParser()
+            self.config.optionxform = str
+            self.load_config(defaults, options)
+            if use_cache:
+                cache.set(cache_key, signature, self.config, host)
 
         if not self.validate_config():
             self.rsv.log("ERROR", "Metric %s is not configured correctly." % self.name)
@@ -48,6 +69,9 @@ class Metric:
         if options and options.ce_type:
             self.ce_type = options.ce_type
 
+        # Resources used by the last execution (a Sysutils.ResourceUsage)
+        self.performance = None
+
         return
 
 
@@ -88,54 +112,35 @@ class Metric:
         above.
 
         """
-        if not os.path.exists(file):
-            self.rsv.log("DEBUG", "Config file '%s' does not exist" % file)
-        elif not os.access(file, os.R_OK):
-            self.rsv.log("WARNING", "Config file '%s' exists but is not readable by RSV user" % file)
-        else:
-            self.rsv.log("INFO", "Loading config file '%s'" % file)
-            try:
-                # Use a separate config parser to read this and then combine
-                # the results into self.config.  Two reasons for this: first,
-                # we want to error out if we see sections other than
-                # [allmetrics.*] in the conf file. Second, we want to put
-                # options in [allmetrics] into the appropriate section for the
-                # current metric (i.e. if self.name is 'foo' then options in
-                # [allmetrics] should go into [foo], options in
-                # [allmetrics env] should go into [foo env], etc).
-                allmetrics = ConfigParser.RawConfigParser()
-                allmetrics.optionxform = str
-                ret = allmetrics.read(file)
-                # Python 2.3 (RHEL-4) does not return anything so we can only do this check
-                # if we get an array back.
-                if ret is not None:
-                    if file not in ret:
-                        self.rsv.log("ERROR", "An unknown error occurred while trying to load config file '%s'" % file)
-
-                # Now combine the sections
-                for section in allmetrics.sections():
-                    if section == 'allmetrics args':
-                        self.rsv.log("WARNING", "Config file '%s' contains deprecated section '%s', which will be ignored" % (file, section))
-                        continue
-                    if section not in ['allmetrics', 'allmetrics env']:
-                        self.rsv.log("CRITICAL", "Config file '%s' contains forbidden section '%s'" % (file, section))
-                        sys.exit(1)
-                    metric_section = re.sub(r'allmetrics', self.name, section)
-                    if not self.config.has_section(metric_section):
-                        continue
-                    for opt in allmetrics.options(section):
-                        value = allmetrics.get(section, opt)
-                        self.rsv.log("DEBUG",
-                                     "Setting option '%s' for section '%s' to '%s' (from allmetrics section)" %
-                                         (opt, metric_section, value))
-                        self.config.set(metric_section, opt, value)
-            except ConfigParser.ParsingError, err:
-                self.rsv.log("CRITICAL", err)
-                sys.exit(1)
+        sections = get_allmetrics_sections(self.rsv, file)
+        if not sections:
+            return
+
+        # Put options in [allmetrics] into the appropriate section for the current
+        # metric (i.e. if self.name is 'foo' then options in [allmetrics] should
+        # go into [foo], options in [allmetrics env] should go into [foo env], etc).
+        count = 0
+        for (section, options) in sections:
+            metric_section = re.sub(r'allmetrics', self.name, section)
+            if not self.config.has_section(metric_section):
+                continue
+            for (opt, value) in options:
+                self.config.set(metric_section, opt, value)
+                count += 1
 
+        self.rsv.log("DEBUG", "Set %s options for metric %s from '%s'" % (count, self.name, file))
         return
 
 
+    def get_config_files(self):
+        """ Return the configuration files read by load_config (except for one
+        given on the command line) """
+        files = [self.meta_file, self.top_config_file]
+        if self.host:
+            files += [self.host_allmetrics_config_file, self.host_config_file]
+        return files
+
+
     def load_config(self, defaults, options=None):
         """ Load metric configuration files """
         if defaults:
@@ -432,6 +437,21 @@ class Metric:
         return string
 
 
+    def get_dependencies(self):
+        """ Return the names of the metrics this metric depends on (the 'depends-on'
+        setting, separated by commas or whitespace) """
+
+        depends_on = self.config_get("depends-on")
+        if not depends_on:
+            return []
+
+        dependencies = []
+        for name in re.split("[\s,]+", depends_on.strip()):
+            if name and name != self.name:
+                dependencies.append(name)
+        return dependencies
+
+
     def get_transfer_files(self):
         """ Return the list of required files to transfer for a probe. """
         try:
@@ -530,13 +550,68 @@ class Metric:
             self.rsv.log("INFO", "Setting config value (%s=%s)" % (key, val))
             local_config.set(section, key, val)
 
-        fp = open(file, 'w')
-        local_config.write(fp)
-        fp.close()
+            # RSV.get_metric hands this object out again, so keep it current
+            if not self.config.has_section(section):
+                self.config.add_section(section)
+            self.config.set(section, key, val)
 
+        Sysutils.write_config(local_config, file)
         return
 
 
+def get_host_config_file(metric_name, host):
+    """ Return the path of the config file for a metric against a host """
+    return os.path.join("/", "etc", "rsv", "metrics", host, metric_name + ".conf")
+
+
+def get_allmetrics_sections(rsv, file):
+    """ Return the [allmetrics] and [allmetrics env] sections of an allmetrics.conf
+    file as a list of (section, [(option, value), ...]).  Each file is read and
+    checked for forbidden sections once, and then shared by every metric for
+    that host. """
+
+    if file in _allmetrics_sections:
+        return _allmetrics_sections[file]
+
+    sections = []
+    if not os.path.exists(file):
+        rsv.log("DEBUG", "Config file '%s' does not exist" % file)
+    elif not os.access(file, os.R_OK):
+        rsv.log("WARNING", "Config file '%s' exists but is not readable by RSV user" % file)
+    else:
+        try:
+            allmetrics = ConfigParser.RawConfigParser()
+            allmetrics.optionxform = str
+            ret = allmetrics.read(file)
+            # Python 2.3 (RHEL-4) does not return anything so we can only do this check
+            # if we get an array back.
+            if ret is not None:
+                if file not in ret:
+                    rsv.log("ERROR", "An unknown error occurred while trying to load config file '%s'" % file)
+        except ConfigParser.ParsingError, err:
+            rsv.log("CRITICAL", err)
+            sys.exit(1)
+
+        count = 0
+        for section in allmetrics.sections():
+            if section == 'allmetrics args':
+                rsv.log("WARNING", "Config file '%s' contains deprecated section '%s', which will be ignored" % (file, section))
+                continue
+            if section not in ['allmetrics', 'allmetrics env']:
+                rsv.log("CRITICAL", "Config file '%s' contains forbidden section '%s'" % (file, section))
+                sys.exit(1)
+            options = []
+            for opt in allmetrics.options(section):
+                options.append((opt, allmetrics.get(section, opt)))
+            sections.append((section, options))
+            count += len(options)
+
+        rsv.log("INFO", "Loaded config file '%s' (%s options in %s sections)" % (file, count, len(sections)))
+
+    _allmetrics_sections[file] = sections
+    return sections
+
+
 def get_metric_defaults(metric_name):
     """ Load metric default values """
     defaults = {}
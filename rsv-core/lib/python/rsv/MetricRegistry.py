@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+class MetricRegistry:
+    """ The installed metrics, by name.  This can be used like a dictionary of
+    Metric objects, but a metric's configuration is only loaded the first time
+    it is looked up (see RSV.get_metric). """
+
+    def __init__(self, rsv):
+        self.rsv = rsv
+        self.names = rsv.get_installed_metrics()
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __iter__(self):
+        return iter(self.names)
+
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        return self.rsv.get_metric(name)
+
+
+    def keys(self):
+        """ Return the names of the installed metrics """
+        return list(self.names)
@@ -4,7 +4,9 @@
 import os
 import re
 import sys
+import time
 import logging
+import calendar
 import ConfigParser
 from pwd import getpwnam
 
@@ -14,6 +16,9 @@ import Metric
 import Results
 import Sysutils
 import Consumer
+import StateFile
+import ConfigCache
+import MetricRegistry
 
 # Define base system paths
 OPENSSL_EXE = "/usr/bin/openssl"
@@ -37,6 +42,9 @@ class RSV:
         self.logger = None
         self.proxy = None
 
+        # Metric objects that have been loaded, by (metric, host)
+        self.metrics = {}
+
         # For any messages that won't go through the logger
         self.quiet = 0
         if self.options.verbose == 0:
@@ -57,9 +65,16 @@ class RSV:
 
     def setup_config(self):
         """ Load configuration """
+        config_file = os.path.join(CONFIG_DIR, "rsv.conf")
+        defaults = get_rsv_defaults()
+        cache = ConfigCache.get_cache(self)
+        signature = cache.get_signature([config_file], defaults)
+        self.config = cache.get("rsv", signature)
+        if self.config is not None:
+            return
+
         self.config = ConfigParser.RawConfigParser()
         self.config.optionxform = str # make keys case-sensitive
-        defaults = get_rsv_defaults()
         if defaults:
             for section in defaults.keys():
                 if not self.config.has_section(section):
@@ -68,15 +83,23 @@ class RSV:
                 for item in defaults[section].keys():
                     self.config.set(section, item, defaults[section][item])
 
-        self.load_config_file(self.config, os.path.join(CONFIG_DIR, "rsv.conf"), required=1)
+        self.load_config_file(self.config, config_file, required=1)
+        cache.set("rsv", signature, self.config)
         return
 
 
     def setup_consumer_config(self):
         """ Load configuration """
+        cache = ConfigCache.get_cache(self)
+        signature = cache.get_signature([CONSUMER_CONFIG_FILE])
+        self.consumer_config = cache.get("consumers", signature)
+        if self.consumer_config is not None:
+            return
+
         self.consumer_config = ConfigParser.RawConfigParser()
         self.consumer_config.optionxform = str # make keys case-sensitive
         self.load_config_file(self.consumer_config, CONSUMER_CONFIG_FILE, required=0)
+        cache.set("consumers", signature, self.consumer_config)
         return
 
 
@@ -140,13 +163,19 @@ class RSV:
 
 
     def get_metric_info(self):
-        """ Return a dictionary with information about each installed metric """
+        """ Return a MetricRegistry with information about each installed metric.
+        Only the metrics that are looked up in it are loaded. """
+        return MetricRegistry.MetricRegistry(self)
+
 
-        metrics = {}
-        for metric in self.get_installed_metrics():
-            metrics[metric] = Metric.Metric(metric, self)
+    def get_metric(self, metric, host=None):
+        """ Return the Metric for metric against host (or its host-independent
+        configuration if host is None).  Each one is only loaded once. """
 
-        return metrics
+        key = (metric, host)
+        if key not in self.metrics:
+            self.metrics[key] = Metric.Metric(metric, self, host)
+        return self.metrics[key]
 
 
 
@@ -335,9 +364,7 @@ class RSV:
         if not os.path.exists(CONSUMER_CONFIG_FILE):
             self.echo("Creating configuration file '%s'" % CONSUMER_CONFIG_FILE)
 
-        config_fp = open(CONSUMER_CONFIG_FILE, 'w')
-        self.consumer_config.write(config_fp)
-        config_fp.close()
+        Sysutils.write_config(self.consumer_config, CONSUMER_CONFIG_FILE)
 
 
     def get_extra_globus_rsl(self):
@@ -354,7 +381,8 @@ class RSV:
 
 
     def get_proxy(self):
-        """ Return the path of the proxy file being used """
+        """ Return the path of the proxy file being used.  Jobs get it through
+        X509_USER_PROXY in the environment built by run_metric.get_job_environment """
         return self.proxy
 
 
@@ -401,10 +429,9 @@ class RSV:
         self.log("INFO", "Using service certificate proxy", 4)
 
         hours_til_expiry = 6
-        seconds_til_expiry = str(hours_til_expiry * 60 * 60)
-        (ret, out, err) = self.run_command([OPENSSL_EXE, "x509", "-in", proxy, "-noout", "-enddate", "-checkend", seconds_til_expiry])
+        (valid, out) = self.check_proxy_lifetime(proxy, hours_til_expiry * 60 * 60)
 
-        if ret == 0:
+        if valid:
             self.log("INFO", "Service certificate valid for at least %s hours." % hours_til_expiry, 4)
         else:
             self.log("INFO", "Service certificate proxy expired or expiring within %s hours.  Renewing it." %
@@ -422,11 +449,6 @@ class RSV:
                 self.results.service_proxy_renewal_failed(metric, cert, key, proxy, out, err)
                 sys.exit(1)
 
-        # Globus needs help finding the service proxy since it probably does not have the
-        # default naming scheme of /tmp/x509_u<UID>
-        os.environ["X509_USER_PROXY"] = proxy
-        os.environ["X509_PROXY_FILE"] = proxy
-
         return
 
 
@@ -445,29 +467,107 @@ class RSV:
         # doesn't seem to like a proxy that has a lifetime of less than 3 hours anyways,
         # so this check might need to be adjusted if that behavior is more understood.
         minutes_til_expiration = 10
-        seconds_til_expiration = str(minutes_til_expiration * 60)
-        (ret, out, err) = self.run_command([OPENSSL_EXE, "x509", "-in", proxy_file, "-noout", "-enddate", "-checkend", seconds_til_expiration])
+        (valid, out) = self.check_proxy_lifetime(proxy_file, minutes_til_expiration * 60)
 
-        if ret:
+        if not valid:
             self.results.expired_user_proxy(metric, proxy_file, out, minutes_til_expiration)
             sys.exit(1)
 
-        # Just in case this isn't the default /tmp/x509_u<UID> we'll explicitly set it
-        os.environ["X509_USER_PROXY"] = proxy_file
-        os.environ["X509_PROXY_FILE"] = proxy_file
-
         return
 
 
-    def run_command(self, command, timeout=None):
-        """ Wrapper for Sysutils.system """
+    def check_proxy_lifetime(self, proxy, seconds):
+        """ Return (valid, output) where valid is True if the proxy will not expire
+        within the next seconds and output is what openssl said about it.
+
+        The proxy's notAfter date is read with openssl once and remembered (keyed
+        by the path, mtime, size and inode of the file) so that later checks of
+        the same proxy do not have to run openssl.  If the date cannot be read we
+        fall back to openssl -checkend. """
+
+        cache = StateFile.StateFile(self, "proxy")
+        try:
+            stat = os.stat(proxy)
+            signature = (stat.st_mtime, stat.st_size, stat.st_ino)
+        except OSError:
+            signature = None
+
+        # StateFile ignores the cache unless it is owned by root or rsv and nobody
+        # else can write it, so a planted entry cannot make a proxy look valid
+        entry = None
+        if signature:
+            entry = cache.get(proxy)
+            if entry and tuple(entry[0]) != signature:
+                entry = None
+
+        if entry:
+            self.log("INFO", "Using cached expiration date of proxy '%s'" % proxy, 4)
+        elif signature:
+            (ret, out, err) = self.run_command([OPENSSL_EXE, "x509", "-in", proxy, "-noout", "-enddate"])
+            end_time = None
+            if ret == 0:
+                end_time = parse_openssl_date(out)
+            if end_time is not None:
+                entry = (signature, end_time, out.strip())
+                cache.set(proxy, entry)
+
+        # Say the same thing openssl -checkend would
+        if entry:
+            (ignored, end_time, enddate) = entry
+            if end_time - time.time() > seconds:
+                return (True, enddate + "\nCertificate will not expire\n")
+            return (False, enddate + "\nCertificate will expire\n")
+
+        (ret, out, err) = self.run_command([OPENSSL_EXE, "x509", "-in", proxy, "-noout", "-enddate", "-checkend", str(seconds)])
+        return (ret == 0, out)
+
+
+    def run_command(self, command, timeout=None, env=None, capture_limit=0, metric=None):
+        """ Wrapper for Sysutils.system.  If env is supplied the command is run with
+        that environment instead of our own.  If capture_limit is set, only that many
+        bytes from the start and end of the output are kept in memory.  If metric is
+        supplied, the resources used are recorded in metric.performance. """
 
         if not timeout:
             # Use the timeout declared in the config file
             timeout = self.config.getint("rsv", "job-timeout")
 
         self.log("INFO", "Running command with timeout (%s seconds):\n\t%s" % (timeout, " ".join(command)))
-        return self.sysutils.system(command, timeout)
+        return self.sysutils.system(command, timeout, env, capture_limit, metric)
+
+
+    def get_capture_limit(self):
+        """ Return how many bytes from the start and from the end of a metric's
+        output to keep in memory.  This follows details-data-trim-length, since
+        output beyond that is trimmed away from the records anyway.
+        0 means keep everything. """
+
+        try:
+            return self.config.getint("rsv", "details-data-trim-length")
+        except ValueError:
+            return 10000
+
+
+    def get_ping_cache_ttl(self):
+        """ Return how many seconds a ping result for a host may be reused.
+        0 means always ping. """
+
+        try:
+            return self.config.getint("rsv", "ping-cache-ttl")
+        except ValueError:
+            self.log("WARNING", "ping-cache-ttl must be an integer.  Not caching ping results.")
+            return 0
+
+
+    def get_dependency_status_ttl(self):
+        """ Return for how many seconds the status of a metric is used to decide
+        whether the metrics that depend on it can run """
+
+        try:
+            return self.config.getint("rsv", "dependency-status-ttl")
+        except ValueError:
+            self.log("WARNING", "dependency-status-ttl must be an integer.  Using 3600.")
+            return 3600
 
 
     def use_condor_g(self):
@@ -485,6 +585,16 @@ class RSV:
             return True
 
 
+    def bundle_grid_metrics(self):
+        """ Return True if the grid metrics run against a host in one rsv-control
+        invocation should be submitted together as a single Condor-G job """
+
+        value = self.config.get("rsv", "bundle-grid-metrics")
+        if value.lower() == "true":
+            return True
+        return False
+
+
     def get_ce_type(self):
         """ Return 'gram', 'htcondor-ce' or None depending on what CE type the
         user has selected in rsv.conf. This setting determines if Condor-G
@@ -522,6 +632,22 @@ class RSV:
 # End of RSV class
 
 
+def parse_openssl_date(output):
+    """ Turn the output of openssl x509 -enddate (e.g. 'notAfter=Jan  2 03:04:05 2027 GMT')
+    into seconds since the epoch.  Returns None if it cannot be parsed. """
+
+    match = re.search(r"notAfter=(\w{3})\s+(\d+) (\d+):(\d+):(\d+) (\d{4}) GMT", output)
+    if not match:
+        return None
+
+    months = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+    if match.group(1) not in months:
+        return None
+
+    (day, hour, minute, second, year) = [int(value) for value in match.groups()[1:]]
+    return calendar.timegm((year, months.index(match.group(1)) + 1, day, hour, minute, second, 0, 0, 0))
+
+
 def get_rsv_defaults():
     """
     This is where to declare defaults for config knobs.
@@ -542,6 +668,19 @@ def get_rsv_defaults():
     # Set the job timeout default in seconds
     set_default_value("rsv", "job-timeout", 1200)
 
+    # Reuse the result of pinging a host for this many seconds, so that the
+    # metrics run against a host during a sweep (or from condor-cron within a
+    # few minutes of each other) do not each ping it again.  0 disables this.
+    set_default_value("rsv", "ping-cache-ttl", 300)
+
+    # A metric that declares depends-on is skipped if one of the metrics it depends
+    # on failed against the same host within this many seconds.
+    set_default_value("rsv", "dependency-status-ttl", 3600)
+
+    # Submit one Condor-G job per host for all of the grid metrics in a run instead
+    # of one job per metric
+    set_default_value("rsv", "bundle-grid-metrics", "False")
+
     return defaults
 
 
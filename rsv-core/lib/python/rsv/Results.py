@@ -11,7 +11,11 @@ import tempfile
 import ConfigParser
 from time import localtime, strftime, strptime, gmtime
 
+# RSV libraries
+import Dependencies
+
 UTC_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+RUNTIME_LOG = os.path.join("/", "var", "log", "rsv", "metric-runtime.log")
 LOCAL_TIME_FORMAT = "%Y-%m-%d %H:%M:%S %Z"
 
 def timestamp(local=False):
@@ -50,6 +54,21 @@ def utc_to_epoch(utc_timestamp):
     return calendar.timegm(time_struct)
 
 
+def add_performance_data(record, performance_data):
+    """ Insert a performanceData line into a record, before detailsData if it is
+    there, otherwise before EOT (or at the end) """
+
+    line = "performanceData: %s\n" % performance_data
+    for marker in ("^detailsData:", "^EOT\s*$"):
+        match = re.search(marker, record, re.MULTILINE)
+        if match:
+            return record[:match.start()] + line + record[match.start():]
+
+    if record and not record.endswith("\n"):
+        record += "\n"
+    return record + line
+
+
 class Results:
     """ A class containing code to handle publishing the result records """
     rsv = None
@@ -130,6 +149,17 @@ class Results:
     def create_records(self, metric, utc_summary, local_summary, epoch_summary, stderr):
         """ Generate a result record for each consumer, and print to the screen """
 
+        # Add the resources used by the metric, if it was run
+        if getattr(metric, "performance", None):
+            performance_data = metric.performance.performance_data()
+            utc_summary   = add_performance_data(utc_summary,   performance_data)
+            local_summary = add_performance_data(local_summary, performance_data)
+            epoch_summary = add_performance_data(epoch_summary, performance_data)
+            self.log_runtime(metric, utc_summary)
+
+        # Remember the status for metrics that depend on this one
+        Dependencies.Dependencies(self.rsv).record(metric, utc_summary)
+
         # Print the local summary to the screen
         self.rsv.log("DEBUG", "STDERR from metric:\n%s\n" % stderr)
         self.rsv.log("INFO", "Result:\n") # separate final output from debug output
@@ -149,6 +179,28 @@ class Results:
 
 
 
+    def log_runtime(self, metric, record):
+        """ Append the resources used by a metric to the runtime log so that expensive
+        metrics can be found later.  One line per execution:
+          <timestamp> <metric> <host> <status> label=value ... """
+
+        status = "UNKNOWN"
+        match = re.search("^metricStatus: (\w+)", record, re.MULTILINE)
+        if match:
+            status = match.group(1)
+
+        line = "%s %s %s %s %s\n" % (timestamp(), metric.name, metric.host, status,
+                                     metric.performance.performance_data())
+        try:
+            log_fp = open(RUNTIME_LOG, 'a')
+            try:
+                log_fp.write(line)
+            finally:
+                log_fp.close()
+        except IOError, err:
+            self.rsv.log("DEBUG", "Could not write to runtime log '%s': %s" % (RUNTIME_LOG, err))
+
+
     def get_summary(self, metric, status, this_host, time, data):
         """ Generate a summary string
         Currently metricStatus and summaryData are identical (per RSVv3)
@@ -307,6 +359,29 @@ class Results:
         self.brief_result(metric, status, data, stderr="")
 
 
+    def host_unreachable(self, metric, reason):
+        """ The host was already found to be down, so the metric was not run """
+
+        status = "CRITICAL"
+        data   = "Host unreachable - metric was not run\n\n"
+        data  += "Reason - %s\n\n" % reason
+        data  += "An earlier check against %s found that the host is down, so the\n" % metric.host
+        data  += "remaining metrics against it are not run until it is checked again.\n"
+
+        self.brief_result(metric, status, data, stderr="")
+
+
+    def prerequisite_failed(self, metric, prerequisite, prerequisite_status):
+        """ A metric this metric depends on is failing, so the metric was not run """
+
+        status = "UNKNOWN"
+        data   = "Prerequisite failed - metric was not run\n\n"
+        data  += "This metric depends on %s, whose latest status against\n" % prerequisite
+        data  += "%s is %s.  Fix the problem reported by %s first.\n" % (metric.host, prerequisite_status, prerequisite)
+
+        self.brief_result(metric, status, data, stderr="")
+
+
     def local_job_failed(self, metric, command, stdout, stderr):
         """ Failed to run a metric of type local """
         status = "CRITICAL"
@@ -340,6 +415,16 @@ class Results:
         self.brief_result(metric, status, data, stderr="")
 
 
+    def no_wlcg_records(self, metric, stdout, stderr):
+        """ A wlcg-multiple metric did not return any records """
+        status = "UNKNOWN"
+        data   = "No records found in wlcg-multiple output\n\n"
+        data  += "Stdout:\n%s\n" % stdout
+        data  += "Stderr:\n%s\n" % stderr
+
+        self.brief_result(metric, status, data, stderr="")
+
+
     def condor_grid_job_aborted(self, metric, log):
         """ Condor-G job was aborted while trying to run metric """
         status = "CRITICAL"
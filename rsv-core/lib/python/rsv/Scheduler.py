@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import os
+import time
+
+# RSV libraries
+import Host
+import HostGate
+import Metric
+import Sysutils
+import Dependencies
+
+
+class Deadline:
+    """ A wall-clock budget for a batch of metrics.  A metric is only started if
+    it can finish before the deadline even if it runs into its timeout. """
+
+    def __init__(self, rsv, seconds=None):
+        self.rsv = rsv
+        self.end_time = None
+        if seconds:
+            self.end_time = time.time() + seconds
+        self.skipped = []
+
+
+    def get_budget(self, metric):
+        """ Return how many seconds the metric may take """
+        return metric.get_timeout() or self.rsv.config.getint("rsv", "job-timeout")
+
+
+    def allows(self, metric):
+        """ Return True if the metric can be started.  Otherwise report it as
+        skipped and return False. """
+
+        if self.end_time is None:
+            return True
+
+        budget = self.get_budget(metric)
+        remaining = self.end_time - time.time()
+        if budget <= remaining:
+            return True
+
+        self.skip(metric, budget, remaining)
+        return False
+
+
+    def allows_bundle(self, metrics):
+        """ Return the metrics that can be run together in one job, which may take
+        as long as all of them together.  The others are reported as skipped. """
+
+        if self.end_time is None:
+            return metrics
+
+        allowed = []
+        total = 0
+        remaining = self.end_time - time.time()
+        for metric in metrics:
+            budget = self.get_budget(metric)
+            if total + budget <= remaining:
+                allowed.append(metric)
+                total += budget
+            else:
+                self.skip(metric, budget, remaining - total)
+        return allowed
+
+
+    def skip(self, metric, budget, remaining):
+        """ Report that the metric is not started because of the deadline """
+        self.rsv.echo("\nSkipping metric %s against host %s: it may take up to %s seconds but only %i "
+                      "seconds are left before the deadline" % (metric.name, metric.host, budget, max(remaining, 0)))
+        self.skipped.append(metric)
+
+
+    def report(self):
+        """ Display the metrics that were skipped because of the deadline """
+
+        if not self.skipped:
+            return
+
+        self.rsv.echo("\nThe following %s metrics were not started because they could not finish "
+                      "before the deadline:" % len(self.skipped))
+        for metric in self.skipped:
+            self.rsv.echo("%s against host %s" % (metric.name, metric.host), 4)
+
+
+class Job:
+    """ A single host/metric pair scheduled to run in a worker process """
+
+    def __init__(self, metric, number):
+        self.metric = metric
+        self.number = number
+        self.command = None
+
+        # Names of metrics in this run that must finish before this one starts
+        self.waits_for = []
+
+
+class Scheduler:
+    """ Run metrics through a bounded pool of worker processes.  Each worker is a
+    separate 'rsv-control --run' invocation for one metric against one host, so it
+    writes the same consumer records that a serial run would.  The output of each
+    worker is captured and displayed as a block once the worker finishes so that
+    output from different metrics is not interleaved.
+
+    Worker slots are shared fairly between hosts: the next metric always comes from
+    the host with the fewest running metrics, and no host gets more than its
+    max-concurrent-metrics limit.  Metrics against a host that a worker has found
+    to be unreachable are not started; they get a 'host unreachable' result.
+    Metrics that could not finish before the deadline are skipped.
+
+    A metric that depends on other metrics in the same run against the same host
+    is not started until they have finished, and is skipped if one of them
+    failed. """
+
+    def __init__(self, rsv, options, max_jobs, gate, deadline, dependencies):
+        self.rsv = rsv
+        self.options = options
+        self.max_jobs = max_jobs
+        self.gate = gate
+        self.deadline = deadline
+        self.dependencies = dependencies
+        self.runner = Sysutils.Runner(rsv)
+        self.running = []
+        self.total = 0
+        self.num_failed = 0
+
+        # Per-host state.  host_order is rotated so that hosts with an equal number
+        # of running metrics take turns.
+        self.host_order = []
+        self.pending = {}
+        self.host_limits = {}
+        self.running_per_host = {}
+
+
+    def add(self, host, metric_name):
+        """ Queue a metric to be run against a host """
+        if host not in self.pending:
+            limit = Host.Host(host, self.rsv).get_max_concurrent_metrics()
+            if limit > 0:
+                self.rsv.log("INFO", "Running at most %s metrics at a time against host %s" % (limit, host))
+            self.host_order.append(host)
+            self.pending[host] = []
+            self.host_limits[host] = limit
+            self.running_per_host[host] = 0
+
+        self.total += 1
+        metric = Metric.Metric(metric_name, self.rsv, host, self.options)
+        self.pending[host].append(Job(metric, self.total))
+
+
+    def order(self):
+        """ Order the metrics against each host by their dependencies and number the
+        jobs in the order they will normally be started """
+
+        number = 0
+        for host in self.host_order:
+            metrics = []
+            for job in self.pending[host]:
+                metrics.append(job.metric)
+
+            jobs = []
+            seen = []
+            for metric in Dependencies.order_metrics(self.rsv, metrics):
+                number += 1
+                job = Job(metric, number)
+                for prerequisite in metric.get_dependencies():
+                    if prerequisite in seen:
+                        job.waits_for.append(prerequisite)
+                seen.append(metric.name)
+                jobs.append(job)
+
+            self.pending[host] = jobs
+
+
+    def is_ready(self, job):
+        """ Return True if none of the metrics the job waits for are still pending
+        or running against the same host """
+
+        if not job.waits_for:
+            return True
+
+        host = job.metric.host
+        unfinished = []
+        for other in self.pending[host]:
+            unfinished.append(other.metric.name)
+        for other in self.running:
+            if other.metric.host == host:
+                unfinished.append(other.metric.name)
+
+        for prerequisite in job.waits_for:
+            if prerequisite in unfinished:
+                return False
+        return True
+
+
+    def get_ready_index(self, host):
+        """ Return the index of the first pending job against host that can start,
+        or None """
+
+        for index in range(len(self.pending[host])):
+            if self.is_ready(self.pending[host][index]):
+                return index
+        return None
+
+
+    def has_pending(self):
+        """ Return True if any metric is still waiting to be started """
+        for host in self.host_order:
+            if self.pending[host]:
+                return True
+        return False
+
+
+    def next_job(self):
+        """ Pick the next job to start, or return None if every host with waiting
+        metrics is at its limit or waiting for prerequisites to finish """
+
+        best = None
+        best_index = None
+        for host in self.host_order:
+            if not self.pending[host]:
+                continue
+            limit = self.host_limits[host]
+            if limit and self.running_per_host[host] >= limit:
+                continue
+            if best is not None and self.running_per_host[host] >= self.running_per_host[best]:
+                continue
+            index = self.get_ready_index(host)
+            if index is not None:
+                best = host
+                best_index = index
+
+        if best is None:
+            return None
+
+        self.host_order.remove(best)
+        self.host_order.append(best)
+        return self.pending[best].pop(best_index)
+
+
+    def get_worker_command(self, metric):
+        """ Build the rsv-control command line that runs a single metric """
+
+        cmd = [self.rsv.get_wrapper(), "-v", str(self.options.verbose)]
+        if self.options.test:
+            cmd.append("--test")
+        else:
+            cmd.append("--run")
+
+        cmd += ["--host", metric.host]
+
+        if self.options.no_ping:
+            cmd.append("--no-ping")
+        if self.options.extra_config_file:
+            cmd += ["--extra-config-file", self.options.extra_config_file]
+        if self.options.ce_type:
+            cmd += ["--ce-type", self.options.ce_type]
+
+        cmd.append(metric.name)
+        return cmd
+
+
+    def start(self, job):
+        """ Start a worker process for the job """
+
+        skip_ping = self.options.no_ping or job.metric.config_getboolean('no-ping') == True
+        reason = self.gate.get_reason(job.metric.host, skip_ping)
+        if reason:
+            self.rsv.echo("\nRunning metric %s against host %s (%s of %s)\n" %
+                          (job.metric.name, job.metric.host, job.number, self.total))
+            self.rsv.results.host_unreachable(job.metric, reason)
+            self.num_failed += 1
+            return
+
+        prerequisite = self.dependencies.get_failed_prerequisite(job.metric)
+        if prerequisite:
+            self.rsv.echo("\nRunning metric %s against host %s (%s of %s)\n" %
+                          (job.metric.name, job.metric.host, job.number, self.total))
+            self.rsv.results.prerequisite_failed(job.metric, prerequisite[0], prerequisite[1])
+            return
+
+        if not self.deadline.allows(job.metric):
+            return
+
+        # Validate (and if necessary renew) the proxy here rather than in the workers
+        # so that concurrent workers do not all try to renew it at the same time.
+        self.rsv.check_proxy(job.metric)
+
+        cmd = self.get_worker_command(job.metric)
+        self.rsv.log("INFO", "Starting worker (%s of %s): %s" % (job.number, self.total, " ".join(cmd)))
+
+        # The workers share the hosts they find to be down with each other
+        env = os.environ.copy()
+        env[HostGate.RUN_ID_VARIABLE] = self.gate.run_id
+
+        # Merge STDOUT and STDERR so that the log messages stay in order with the
+        # rest of the metric output.  Workers enforce the metric timeouts themselves.
+        # Large output is kept on disk, as for a metric run in this process.
+        job.command = self.runner.start(cmd, env=env, merge_stderr=True,
+                                        capture_limit=self.rsv.get_capture_limit())
+        self.running.append(job)
+        self.running_per_host[job.metric.host] += 1
+
+
+    def finish(self, job):
+        """ Display the output of a finished worker """
+
+        ret = job.command.returncode
+        self.rsv.log("INFO", "Worker for metric %s against host %s exited with code %s after %.1f seconds" %
+                     (job.metric.name, job.metric.host, ret, job.command.elapsed))
+
+        output = job.command.get_stdout()
+
+        self.rsv.echo("\nRunning metric %s against host %s (%s of %s)\n" %
+                      (job.metric.name, job.metric.host, job.number, self.total))
+        if output:
+            self.rsv.echo(output.rstrip("\n"))
+
+        if ret != 0:
+            self.num_failed += 1
+            self.rsv.log("WARNING", "Metric %s against host %s exited with code %s" %
+                         (job.metric.name, job.metric.host, ret))
+
+
+    def abandon_pending(self):
+        """ Report the metrics that are still waiting as not run """
+
+        for host in self.host_order:
+            for job in self.pending[host]:
+                self.rsv.log("ERROR", "Metric %s against host %s could not be started" %
+                             (job.metric.name, job.metric.host))
+                self.num_failed += 1
+                if job.waits_for:
+                    self.rsv.echo("\nRunning metric %s against host %s (%s of %s)\n" %
+                                  (job.metric.name, job.metric.host, job.number, self.total))
+                    self.rsv.results.prerequisite_failed(job.metric, job.waits_for[0], "unknown because it never ran")
+            self.pending[host] = []
+
+
+    def run(self):
+        """ Run all queued metrics, keeping at most max_jobs workers busy.
+        Returns True if every worker exited successfully. """
+
+        self.rsv.log("INFO", "Running %s metrics with up to %s workers" % (self.total, self.max_jobs))
+        self.order()
+
+        try:
+            while self.has_pending() or self.running:
+                while len(self.running) < self.max_jobs:
+                    job = self.next_job()
+                    if job is None:
+                        break
+                    self.start(job)
+
+                if not self.running:
+                    # Nothing can finish that would let the remaining metrics start
+                    self.abandon_pending()
+                    break
+
+                for command in self.runner.poll():
+                    for job in self.running[:]:
+                        if job.command is command:
+                            self.running.remove(job)
+                            self.running_per_host[job.metric.host] -= 1
+                            self.finish(job)
+        except:
+            self.runner.kill_all()
+            raise
+
+        self.deadline.report()
+        return self.num_failed == 0 and not self.deadline.skipped
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import os
+import time
+import fcntl
+import marshal
+import tempfile
+
+# RSV libraries
+import Sysutils
+
+STATE_DIR = os.path.join(Sysutils.RSV_TMP_DIR, "state")
+
+class StateFile:
+    """ A small dictionary stored on disk so that separate rsv-control processes
+    (condor-cron jobs, --jobs workers) can share results with each other.  Every
+    entry is stored with the time it was set so that callers can ignore stale
+    entries.  Values must be simple types (strings, numbers, tuples, lists, dicts)
+    because the file is written with marshal. """
+
+    def __init__(self, rsv, name):
+        self.rsv = rsv
+        self.path = os.path.join(STATE_DIR, name + ".state")
+        self.lock_path = self.path + ".lock"
+
+
+    def validate_directory(self):
+        """ Create the state directory if it does not exist.  Returns False if it
+        cannot be created or is not owned by root or rsv. """
+
+        if Sysutils.make_rsv_dir(STATE_DIR):
+            return True
+
+        self.rsv.log("WARNING", "State directory '%s' could not be created or is not owned by root or rsv" %
+                     STATE_DIR)
+        return False
+
+
+    def read(self):
+        """ Return the whole dictionary, or an empty one if the file does not exist
+        or cannot be read """
+
+        try:
+            state_fd = os.open(self.path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        except OSError:
+            return {}
+
+        state_fp = os.fdopen(state_fd, 'rb')
+        try:
+            # Both root and rsv act on what is in here, so we do not want to read
+            # anything that somebody else could have written
+            if not Sysutils.is_trusted(STATE_DIR, directory=True) or \
+                   not Sysutils.is_trusted_stat(os.fstat(state_fd)):
+                self.rsv.log("WARNING", "Ignoring state file '%s' because it or its directory is not " % self.path +
+                             "owned by root or rsv, or can be written by others")
+                return {}
+
+            try:
+                state = marshal.load(state_fp)
+            except (EOFError, ValueError, TypeError), err:
+                self.rsv.log("DEBUG", "Ignoring unreadable state file '%s': %s" % (self.path, err))
+                state = {}
+        finally:
+            state_fp.close()
+
+        if not isinstance(state, dict):
+            return {}
+        return state
+
+
+    def get(self, key, max_age=None):
+        """ Return the value stored for key.  If max_age (in seconds) is supplied,
+        entries older than that are treated as missing.  Returns None if there is
+        no usable entry. """
+
+        entry = self.get_entry(key, max_age)
+        if entry is None:
+            return None
+        return entry[0]
+
+
+    def get_entry(self, key, max_age=None):
+        """ Like get, but return (value, age) where age is how many seconds ago
+        the value was set.  Returns None if there is no usable entry. """
+
+        entry = self.read().get(key)
+        if entry is None:
+            return None
+
+        (timestamp, value) = entry
+        age = time.time() - timestamp
+        if max_age is not None and age > max_age:
+            self.rsv.log("DEBUG", "State entry '%s' in '%s' is older than %s seconds" % (key, self.path, max_age))
+            return None
+
+        return (value, age)
+
+
+    def update(self, changes):
+        """ Set several keys at once.  A value of None removes the key.  The file is
+        rewritten atomically while holding an exclusive lock so that concurrent
+        writers do not lose each other's entries. """
+
+        if not self.validate_directory():
+            return False
+
+        # flock does not need write access, so the lock file can be shared by root
+        # and rsv even though only its owner can write to it
+        try:
+            lock_fd = os.open(self.lock_path, os.O_RDONLY | os.O_CREAT, 0644)
+        except OSError, err:
+            self.rsv.log("WARNING", "Could not open lock file '%s': %s" % (self.lock_path, err))
+            return False
+
+        try:
+            rsv_ids = Sysutils.get_rsv_ids()
+            if os.getuid() == 0 and rsv_ids and os.fstat(lock_fd).st_uid == 0:
+                os.fchown(lock_fd, rsv_ids[0], rsv_ids[1])
+
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+            state = self.read()
+            now = time.time()
+            for key in changes.keys():
+                if changes[key] is None:
+                    if key in state:
+                        del state[key]
+                else:
+                    state[key] = (now, changes[key])
+
+            try:
+                (file_handle, tmp_path) = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                                           dir=STATE_DIR)
+                try:
+                    tmp_fp = os.fdopen(file_handle, 'wb')
+                    try:
+                        marshal.dump(state, tmp_fp)
+                    finally:
+                        tmp_fp.close()
+                    # mkstemp creates the file readable only by us, but rsv-control run as
+                    # root and the condor-cron jobs run as rsv read each other's state
+                    os.chmod(tmp_path, 0644)
+                    os.rename(tmp_path, self.path)
+                except:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+            except (IOError, OSError), err:
+                self.rsv.log("WARNING", "Could not write state file '%s': %s" % (self.path, err))
+                return False
+        finally:
+            os.close(lock_fd)
+
+        return True
+
+
+    def set(self, key, value):
+        """ Store a value for key """
+        return self.update({key: value})
+
+
+    def remove(self):
+        """ Remove the whole file """
+        for path in (self.path, self.lock_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def delete(self, key):
+        """ Remove key """
+        return self.update({key: None})
@@ -2,19 +2,492 @@
 
 # Global libraries
 import os
-import re
+import pwd
 import sys
 import time
+import errno
+import fcntl
+import select
 import signal
+import stat
+import shutil
+import tempfile
 import subprocess
 
+# Where RSV keeps its temporary files and state
+RSV_TMP_DIR = os.path.join("/", "var", "tmp", "rsv")
+
+# Where the complete output of commands is kept when it is too big to hold in memory
+SPILL_DIR = RSV_TMP_DIR
+SPILL_PREFIX = "output-"
+
+# Spill files older than this (in seconds) are removed
+SPILL_MAX_AGE = 7 * 24 * 60 * 60
+
 class TimeoutError(Exception):
     """ This defines an Exception that we can use if our system call times out """
     pass
-            
 
-def alarm_handler(signum, frame):
-    raise TimeoutError("System call timed out")
+
+def truncation_notice(omitted, spill_path):
+    """ Return the text that replaces the middle of output that was too large """
+    notice = "\n[... %s bytes omitted" % omitted
+    if spill_path:
+        notice += ", complete output saved in %s" % spill_path
+    return notice + " ...]\n"
+
+
+def make_spill_file():
+    """ Create a file to hold output that is too large to keep in memory.
+    Returns an open file object and its path, or (None, None). """
+    prune_spill_files()
+    try:
+        (file_handle, path) = tempfile.mkstemp(prefix=SPILL_PREFIX, dir=SPILL_DIR)
+        return os.fdopen(file_handle, 'w'), path
+    except (IOError, OSError):
+        return None, None
+
+
+def prune_spill_files():
+    """ Remove the spill files that are more than SPILL_MAX_AGE seconds old """
+
+    try:
+        names = os.listdir(SPILL_DIR)
+    except OSError:
+        return
+
+    cutoff = time.time() - SPILL_MAX_AGE
+    for name in names:
+        if not name.startswith(SPILL_PREFIX):
+            continue
+        path = os.path.join(SPILL_DIR, name)
+        try:
+            if os.lstat(path).st_mtime < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def get_rsv_ids():
+    """ Return the (uid, gid) of the rsv user, or None if there is no such user """
+    try:
+        return tuple(pwd.getpwnam('rsv')[2:4])
+    except KeyError:
+        return None
+
+
+def is_trusted(path, directory=False):
+    """ Return True if path is a regular file (or a directory, if directory is
+    True) that is owned by root or rsv and cannot be written by anyone else.
+    Symlinks are never trusted. """
+
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+
+    return is_trusted_stat(info, directory)
+
+
+def is_trusted_stat(info, directory=False):
+    """ Like is_trusted, but check the result of os.lstat or os.fstat """
+
+    if directory:
+        if not stat.S_ISDIR(info.st_mode):
+            return False
+    elif not stat.S_ISREG(info.st_mode):
+        return False
+
+    rsv_ids = get_rsv_ids()
+    if info.st_uid != 0 and (rsv_ids is None or info.st_uid != rsv_ids[0]):
+        return False
+
+    return not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def make_rsv_dir(path):
+    """ Create a directory under /var/tmp/rsv, creating /var/tmp/rsv too if needed.
+    /var/tmp/rsv can be periodically deleted by system cleanup utilities so we
+    sometimes have to re-create it.  Directories created by root are given to
+    rsv.  Returns True if the directory can be trusted (see is_trusted) and False
+    if it could not be created or somebody else owns it. """
+
+    parent_dir = os.path.dirname(path)
+    if path != RSV_TMP_DIR and parent_dir.startswith(RSV_TMP_DIR):
+        if not make_rsv_dir(parent_dir):
+            return False
+
+    try:
+        os.mkdir(path, 0755)
+        rsv_ids = get_rsv_ids()
+        if os.getuid() == 0 and rsv_ids:
+            os.chown(path, rsv_ids[0], rsv_ids[1])
+    except OSError, err:
+        if err.errno != errno.EEXIST:
+            return False
+
+    return is_trusted(path, directory=True)
+
+
+def write_config(config, path):
+    """ Write a ConfigParser object to path.  The file is written under a
+    temporary name in the same directory and renamed over the old one, so
+    nothing ever reads a half-written file.  The mode (and, for root, the owner)
+    of an existing file is kept.  Raises IOError or OSError on failure. """
+
+    mode = 0644
+    owner = None
+    if os.path.exists(path):
+        info = os.stat(path)
+        mode = info.st_mode & 07777
+        if os.getuid() == 0:
+            owner = (info.st_uid, info.st_gid)
+
+    (file_handle, tmp_path) = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".",
+                                               dir=os.path.dirname(path))
+    try:
+        config_fp = os.fdopen(file_handle, 'w')
+        try:
+            config.write(config_fp)
+        finally:
+            config_fp.close()
+        os.chmod(tmp_path, mode)
+        if owner:
+            os.chown(tmp_path, owner[0], owner[1])
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class ResourceUsage:
+    """ The resources used by a finished command.  CPU times and maximum resident
+    set size come from wait4() and are None when they are not known (for example
+    for jobs that ran under Condor). """
+
+    def __init__(self, wall, user=None, system=None, max_rss=None, timed_out=False):
+        self.wall = wall
+        self.user = user
+        self.system = system
+        self.max_rss = max_rss
+        self.timed_out = timed_out
+
+
+    def get_values(self):
+        """ Return a list of (label, value) pairs for the known values """
+
+        values = [("wall", "%.2fs" % self.wall)]
+        if self.user is not None:
+            values.append(("cpu_user", "%.2fs" % self.user))
+        if self.system is not None:
+            values.append(("cpu_sys", "%.2fs" % self.system))
+        if self.max_rss is not None:
+            values.append(("max_rss", "%dKB" % self.max_rss))
+        values.append(("timed_out", "%d" % int(self.timed_out)))
+        return values
+
+
+    def performance_data(self):
+        """ Format the usage as performanceData (label=value pairs) """
+        return " ".join(["%s=%s" % pair for pair in self.get_values()])
+
+
+class OutputBuffer:
+    """ Collect one output stream of a command.  If a limit is set and the stream
+    grows beyond twice that size, only the first and last 'limit' bytes are kept in
+    memory and the complete stream is written to a spill file instead, so a runaway
+    command cannot exhaust our memory. """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.size = 0
+        self.chunks = []
+        self.head = ""
+        self.tail = ""
+        self.spill_fp = None
+        self.spill_path = None
+        self.truncated = False
+
+
+    def write(self, data):
+        """ Add data to the buffer """
+
+        self.size += len(data)
+        if not self.truncated:
+            self.chunks.append(data)
+            if not self.limit or self.size <= 2 * self.limit:
+                return
+
+            # From now on only keep the head and tail in memory
+            contents = "".join(self.chunks)
+            self.chunks = []
+            self.truncated = True
+            self.head = contents[:self.limit]
+            self.tail = contents[-self.limit:]
+            (self.spill_fp, self.spill_path) = make_spill_file()
+            data = contents
+        else:
+            self.tail = (self.tail + data)[-self.limit:]
+
+        if self.spill_fp:
+            self.spill_fp.write(data)
+
+
+    def close(self):
+        """ Close the spill file, if there is one """
+        if self.spill_fp:
+            self.spill_fp.close()
+            self.spill_fp = None
+
+
+    def getvalue(self):
+        """ Return the collected output.  If it was too large, the middle is
+        replaced by a note saying where to find the complete output. """
+        if not self.truncated:
+            return "".join(self.chunks)
+
+        omitted = self.size - len(self.head) - len(self.tail)
+        return self.head + truncation_notice(omitted, self.spill_path) + self.tail
+
+
+class Command:
+    """ A child process started by a Runner.  The child is the leader of its own
+    process group so that everything it starts can be killed together. """
+
+    def __init__(self, command, timeout=None, env=None, merge_stderr=False, capture_limit=0):
+        self.command = command
+        self.timeout = timeout
+        self.returncode = None
+        self.timed_out = False
+        self.elapsed = None
+        self.rusage = None
+        self.pipes = {}
+        self.output = {"stdout": OutputBuffer(capture_limit), "stderr": OutputBuffer(capture_limit)}
+
+        stderr = subprocess.PIPE
+        if merge_stderr:
+            stderr = subprocess.STDOUT
+
+        self.start_time = time.time()
+        self.deadline = None
+        if timeout:
+            self.deadline = self.start_time + timeout
+
+        devnull = open(os.devnull)
+        try:
+            self.process = subprocess.Popen(command, stdin=devnull, stdout=subprocess.PIPE,
+                                            stderr=stderr, env=env, close_fds=True, preexec_fn=os.setsid)
+        finally:
+            # The child has its own copy
+            devnull.close()
+        self.pid = self.process.pid
+
+        self.pipes[self.process.stdout.fileno()] = ("stdout", self.process.stdout)
+        if not merge_stderr:
+            self.pipes[self.process.stderr.fileno()] = ("stderr", self.process.stderr)
+
+        for fd in self.pipes.keys():
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+    def finished(self):
+        """ Return True once the child has been reaped """
+        return self.returncode is not None
+
+
+    def kill(self):
+        """ Kill the child and everything else in its process group """
+        try:
+            os.killpg(self.pid, signal.SIGKILL)
+        except OSError:
+            # The group is already gone
+            pass
+
+
+    def get_usage(self):
+        """ Return a ResourceUsage describing what the child (and the children it
+        waited for) used.  Only meaningful once the child has been reaped. """
+
+        if self.rusage is None:
+            return ResourceUsage(self.elapsed or 0, timed_out=self.timed_out)
+
+        return ResourceUsage(self.elapsed, self.rusage.ru_utime, self.rusage.ru_stime,
+                             self.rusage.ru_maxrss, self.timed_out)
+
+
+    def get_stdout(self):
+        """ Return what the child wrote to STDOUT """
+        return self.output["stdout"].getvalue()
+
+
+    def get_stderr(self):
+        """ Return what the child wrote to STDERR """
+        return self.output["stderr"].getvalue()
+
+
+class Runner:
+    """ Run any number of child processes at the same time.  Output is collected
+    from non-blocking pipes with poll() and every child has its own deadline, so
+    nothing depends on SIGALRM (which is process-wide and can only time one
+    command at a time). """
+
+    def __init__(self, rsv):
+        self.rsv = rsv
+        self.active = []
+        self.poller = select.poll()
+        self.fds = {}
+
+
+    def start(self, command, timeout=None, env=None, merge_stderr=False, capture_limit=0):
+        """ Start a command and return its Command object.  A timeout of None or 0
+        means the command may run forever.  If capture_limit is set, at most that
+        many bytes from the start and from the end of each output stream are kept
+        in memory (see OutputBuffer). """
+
+        cmd = Command(command, timeout, env, merge_stderr, capture_limit)
+        for fd in cmd.pipes.keys():
+            self.fds[fd] = cmd
+            self.poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR)
+        self.active.append(cmd)
+        return cmd
+
+
+    def read(self, fd):
+        """ Read what is available on a pipe.  Close the pipe at EOF. """
+
+        cmd = self.fds[fd]
+        (name, pipe) = cmd.pipes[fd]
+        try:
+            data = os.read(fd, 65536)
+        except OSError, err:
+            if err.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ""
+
+        if data:
+            cmd.output[name].write(data)
+        else:
+            self.poller.unregister(fd)
+            del self.fds[fd]
+            del cmd.pipes[fd]
+            pipe.close()
+
+
+    def close_pipes(self, cmd):
+        """ Read whatever is left on the pipes of a finished command and close them """
+        for fd in cmd.pipes.keys():
+            while fd in cmd.pipes:
+                self.read(fd)
+                if fd in cmd.pipes and not select.select([fd], [], [], 0)[0]:
+                    self.poller.unregister(fd)
+                    del self.fds[fd]
+                    cmd.pipes[fd][1].close()
+                    del cmd.pipes[fd]
+
+
+    def reap(self, cmd):
+        """ Collect the exit status and resource usage of a child if it has exited """
+
+        try:
+            (pid, status, rusage) = os.wait4(cmd.pid, os.WNOHANG)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                return False
+            # Somebody else reaped it, so we cannot tell how it exited
+            self.rsv.log("WARNING", "Could not get the exit status of process %s: %s" % (cmd.pid, err))
+            (pid, status, rusage) = (cmd.pid, None, None)
+
+        if pid == 0:
+            return False
+
+        cmd.elapsed = time.time() - cmd.start_time
+        cmd.rusage = rusage
+        if status is None:
+            cmd.returncode = -1
+        elif os.WIFSIGNALED(status):
+            cmd.returncode = -os.WTERMSIG(status)
+        else:
+            cmd.returncode = os.WEXITSTATUS(status)
+
+        # Keep subprocess from trying to reap the child again
+        cmd.process.returncode = cmd.returncode
+        return True
+
+
+    def poll(self, timeout=None):
+        """ Wait up to timeout seconds (forever if None) for something to happen.
+        Returns the list of commands that finished. """
+
+        now = time.time()
+
+        # Kill anything that has run past its deadline
+        wait = timeout
+        for cmd in self.active:
+            if cmd.deadline is None or cmd.timed_out:
+                continue
+            if now >= cmd.deadline:
+                self.rsv.log("ERROR", "Command timed out (timeout=%s): %s" % (cmd.timeout, cmd.command))
+                cmd.timed_out = True
+                cmd.kill()
+            elif wait is None or cmd.deadline - now < wait:
+                wait = cmd.deadline - now
+
+        # A child that closed its pipes may not have exited yet, so don't block for long
+        for cmd in self.active:
+            if not cmd.pipes and (wait is None or wait > 0.1):
+                wait = 0.1
+
+        if self.fds:
+            if wait is None:
+                events = self.poller.poll()
+            else:
+                events = self.poller.poll(int(wait * 1000) + 1)
+        else:
+            events = []
+            if wait:
+                time.sleep(wait)
+
+        for (fd, event) in events:
+            if fd in self.fds:
+                self.read(fd)
+
+        finished = []
+        for cmd in self.active[:]:
+            if cmd.pipes and not cmd.timed_out:
+                continue
+            if self.reap(cmd):
+                self.close_pipes(cmd)
+                for name in cmd.output.keys():
+                    buffer = cmd.output[name]
+                    buffer.close()
+                    if buffer.truncated:
+                        self.rsv.log("WARNING", "Command wrote %s bytes to %s.  Complete output saved in %s" %
+                                     (buffer.size, name, buffer.spill_path))
+                self.active.remove(cmd)
+                finished.append(cmd)
+
+        return finished
+
+
+    def wait(self, cmd=None):
+        """ Wait until cmd (or every command if cmd is None) has finished.  If we
+        are interrupted, kill everything we started. """
+
+        try:
+            while self.active:
+                if cmd is not None and cmd.finished():
+                    break
+                self.poll()
+        except:
+            self.kill_all()
+            raise
+
+
+    def kill_all(self):
+        """ Kill every running command """
+        for cmd in self.active:
+            cmd.kill()
 
 
 class Sysutils:
@@ -24,32 +497,30 @@ class Sysutils:
         self.rsv = rsv
 
 
-    def system(self, command, timeout):
-        """ Run a system command with a timeout specified (in seconds).
+    def system(self, command, timeout, env=None, capture_limit=0, metric=None):
+        """ Run a system command with a timeout specified (in seconds).  If env is
+        supplied it is used as the environment of the command.  If capture_limit is
+        set, large output is trimmed in the middle (see OutputBuffer).  If metric is
+        supplied, the resources used by the command are stored in metric.performance.
         Returns:
           1) exit code
           2) STDOUT
           3) STDERR
+        Raises TimeoutError if the command had to be killed.
         """
 
-        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(timeout)
-        try:
-            (stdout, stderr) = p.communicate()
-            signal.alarm(0)
-        except TimeoutError:
-            # p.kill() is new in Python 2.6 and we support Python 2.4 so we need to have a fallback
-            if hasattr(p, "kill"):
-                p.kill()
-            else:
-                os.kill(p.pid, signal.SIGKILL)
-                
-            self.rsv.log("ERROR", "Command timed out (timeout=%s): %s" % (timeout, command))
+        runner = Runner(self.rsv)
+        cmd = runner.start(command, timeout, env, capture_limit=capture_limit)
+        runner.wait(cmd)
+
+        if metric is not None:
+            metric.performance = cmd.get_usage()
+
+        if cmd.timed_out:
             raise TimeoutError("Command timed out (timeout=%s)" % timeout)
 
-        self.rsv.log("INFO", "Exit code of job: %s" % p.returncode)
-        return p.returncode, stdout, stderr
+        self.rsv.log("INFO", "Exit code of job: %s (%.2f seconds)" % (cmd.returncode, cmd.elapsed))
+        return cmd.returncode, cmd.get_stdout(), cmd.get_stderr()
 
 
     def switch_user(self, user, desired_uid, desired_gid):
@@ -80,33 +551,6 @@ class Sysutils:
                 sys.exit(1)
 
 
-    def watch_log(self, log_path, keywords, timeout=300, sleep_interval=10):
-        """ Watch the specified log for the keywords.  Return the keyword that matches. """
-
-        self.rsv.log("DEBUG", "Watching log '%s' for keywords [%s].  Timeout is %ss" %
-                     (log_path, ', '.join(keywords), timeout))
-
-        start_time = int(time.time())
-        mtime = 0
-
-        while 1:
-            if int(time.time()) - start_time >= timeout:
-                raise TimeoutError("Timeout while watching log (%ss)" % timeout)
-            
-            new_mtime = os.stat(log_path).st_mtime
-            if new_mtime != mtime:
-                mtime = new_mtime
-                contents = self.slurp(log_path)
-
-                for keyword in keywords:
-                    if re.search(keyword, contents):
-                        return keyword, contents
-
-            time.sleep(sleep_interval)
-        
-        return None, None
-    
-
     def slurp(self, file, must_exist=0):
         """ Given a path, read the contents of that file """
         self.rsv.log("DEBUG", "Slurping file '%s'" % file)
@@ -127,6 +571,44 @@ class Sysutils:
         return contents
 
 
+    def slurp_bounded(self, file, limit):
+        """ Like slurp, but if the file is larger than twice limit bytes, return only
+        its first and last limit bytes.  The file is then copied to a spill file
+        so the complete contents can still be inspected. """
+
+        try:
+            size = os.path.getsize(file)
+        except OSError:
+            size = 0
+
+        if not limit or size <= 2 * limit:
+            return self.slurp(file)
+
+        self.rsv.log("DEBUG", "Slurping first and last %s bytes of file '%s' (%s bytes)" % (limit, file, size))
+
+        try:
+            f = open(file, 'r')
+            head = f.read(limit)
+            f.seek(-limit, 2)
+            tail = f.read()
+            f.close()
+        except IOError, err:
+            self.rsv.log("DEBUG", "Could not read file: %s" % err, indent=4)
+            return ""
+
+        (spill_fp, spill_path) = make_spill_file()
+        if spill_fp:
+            spill_fp.close()
+            try:
+                shutil.copyfile(file, spill_path)
+            except (IOError, OSError), err:
+                self.rsv.log("WARNING", "Could not save complete contents of '%s': %s" % (file, err))
+                spill_path = None
+
+        self.rsv.log("WARNING", "File '%s' is %s bytes.  Complete contents saved in %s" % (file, size, spill_path))
+        return head + truncation_notice(size - len(head) - len(tail), spill_path) + tail
+
+
     def which(self, program):
         """ Examine the path for supplied binary.  Return path to binary or None if not found """
 
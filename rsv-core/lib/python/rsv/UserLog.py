@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+# Standard libraries
+import os
+import re
+import time
+import select
+
+# inotify is used through ctypes when it is available (Linux, Python 2.6+)
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# RSV libraries
+import Sysutils
+
+# inotify event masks (from <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+# How long to sleep between reads of the log if inotify is not available
+SLEEP_INTERVAL = 1
+
+# Even with inotify, read the log at least this often in case an event was missed
+RECHECK_INTERVAL = 5
+
+# The first line of each event, e.g. '005 (1234.000.000) 01/23 12:34:56 Job terminated.'
+EVENT_HEADER = re.compile(r"^(\d{3}) \((\d+)\.(\d+)\.\d+\) ")
+
+# Event codes (ULogEventNumber in HTCondor)
+SUBMIT = 0
+EXECUTE = 1
+EXECUTABLE_ERROR = 2
+SHADOW_EXCEPTION = 7
+JOB_TERMINATED = 5
+JOB_ABORTED = 9
+JOB_HELD = 12
+GLOBUS_SUBMIT_FAILED = 18
+GLOBUS_RESOURCE_DOWN = 20
+GRID_RESOURCE_DOWN = 26
+
+# How a job ended, as returned by CondorG.wait
+SUCCEEDED = 0
+ABORTED = 1
+FAILED = 2
+SUBMISSION_FAILED = 3
+RESOURCE_DOWN = 4
+TIMED_OUT = 5
+HELD = 6
+
+OUTCOMES = {EXECUTABLE_ERROR: FAILED,
+            SHADOW_EXCEPTION: FAILED,
+            JOB_ABORTED: ABORTED,
+            JOB_HELD: HELD,
+            GLOBUS_SUBMIT_FAILED: SUBMISSION_FAILED,
+            GLOBUS_RESOURCE_DOWN: RESOURCE_DOWN,
+            GRID_RESOURCE_DOWN: RESOURCE_DOWN}
+
+
+class UserLogEvent:
+    """ A single event from a Condor user log """
+
+    def __init__(self, code, cluster_id, proc_id, text):
+        self.code = code
+        self.cluster_id = cluster_id
+        self.proc_id = proc_id
+        self.text = text
+
+        # Set for JOB_TERMINATED events
+        self.return_value = None
+        self.signal = None
+        if code == JOB_TERMINATED:
+            match = re.search(r"Normal termination \(return value (-?\d+)\)", text)
+            if match:
+                self.return_value = int(match.group(1))
+            match = re.search(r"Abnormal termination \(signal (\d+)\)", text)
+            if match:
+                self.signal = int(match.group(1))
+
+
+    def get_outcome(self):
+        """ Return how the job ended (SUCCEEDED, ABORTED, ...) if this event means
+        that we should stop waiting for it, or None otherwise """
+
+        if self.code == JOB_TERMINATED:
+            if self.signal is not None:
+                return FAILED
+            return SUCCEEDED
+
+        return OUTCOMES.get(self.code)
+
+
+class UserLog:
+    """ Read the events from a Condor user log as it grows.  Only the new part of
+    the log is read each time, and an event is only returned once all of it has
+    been written. """
+
+    def __init__(self, rsv, path):
+        self.rsv = rsv
+        self.path = path
+        self.offset = 0
+        self.partial = ""
+
+
+    def read_events(self):
+        """ Return the events written since the last call """
+
+        try:
+            log_fp = open(self.path, 'r')
+        except IOError:
+            # Condor has not created the log yet
+            return []
+
+        try:
+            log_fp.seek(self.offset)
+            data = log_fp.read()
+        finally:
+            log_fp.close()
+
+        self.offset += len(data)
+
+        # Events end with a line containing '...'.  Anything after the last one is
+        # kept until the rest of the event is written.
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+
+        events = []
+        event_lines = []
+        for line in lines:
+            if line.strip() != "...":
+                event_lines.append(line)
+                continue
+
+            event = parse_event(event_lines)
+            if event:
+                events.append(event)
+            else:
+                self.rsv.log("DEBUG", "Ignoring unrecognized user log entry in '%s':\n%s" %
+                             (self.path, "\n".join(event_lines)))
+            event_lines = []
+
+        if event_lines:
+            self.partial = "\n".join(event_lines + [self.partial])
+
+        return events
+
+
+    def wait(self, cluster_id, timeout):
+        """ Wait until a job in cluster_id has finished (see UserLogEvent.get_outcome)
+        and return the event that says so.  Raises Sysutils.TimeoutError if that
+        does not happen within timeout seconds. """
+
+        self.rsv.log("DEBUG", "Watching log '%s' for job %s.  Timeout is %ss" % (self.path, cluster_id, timeout))
+
+        cluster_id = str(cluster_id)
+        end_time = time.time() + timeout
+        watcher = LogWatcher(self.rsv, self.path)
+        try:
+            while 1:
+                for event in self.read_events():
+                    self.rsv.log("DEBUG", "Job %s.%s: event %03d" % (event.cluster_id, event.proc_id, event.code))
+                    if event.cluster_id == cluster_id and event.get_outcome() is not None:
+                        return event
+
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    raise Sysutils.TimeoutError("Timeout while watching log (%ss)" % timeout)
+
+                watcher.wait(remaining)
+        finally:
+            watcher.close()
+
+
+class LogWatcher:
+    """ Wait for a log file to change.  inotify is used if it is available.
+    Otherwise we just sleep for a short time. """
+
+    def __init__(self, rsv, path):
+        self.rsv = rsv
+        self.fd = None
+
+        if ctypes is None:
+            return
+
+        # Watch the directory since the log might not exist yet
+        directory = os.path.dirname(path) or "."
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                return
+            if libc.inotify_add_watch(fd, directory, IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO) < 0:
+                os.close(fd)
+                return
+            self.fd = fd
+        except (OSError, AttributeError, TypeError), err:
+            self.rsv.log("DEBUG", "inotify is not available (%s).  Polling '%s'." % (err, path))
+
+
+    def wait(self, timeout):
+        """ Return when the file might have changed, or after at most timeout seconds """
+
+        if self.fd is None:
+            time.sleep(min(timeout, SLEEP_INTERVAL))
+            return
+
+        try:
+            (ready, ignored, ignored) = select.select([self.fd], [], [], min(timeout, RECHECK_INTERVAL))
+            if ready:
+                # We only care that something happened, not what
+                os.read(self.fd, 4096)
+        except (select.error, OSError):
+            time.sleep(min(timeout, SLEEP_INTERVAL))
+
+
+    def close(self):
+        """ Stop watching """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def get_job_text(rsv, path, cluster_id):
+    """ Return the events for one cluster from a user log shared by several jobs """
+    events = UserLog(rsv, path).read_events()
+    return "\n...\n".join([event.text for event in events if event.cluster_id == str(cluster_id)])
+
+
+def parse_event(lines):
+    """ Turn the lines of one user log event into a UserLogEvent, or return None if
+    they are not an event we understand """
+
+    while lines and not lines[0].strip():
+        lines = lines[1:]
+
+    if not lines:
+        return None
+
+    match = EVENT_HEADER.match(lines[0])
+    if not match:
+        return None
+
+    return UserLogEvent(int(match.group(1)), str(int(match.group(2))), str(int(match.group(3))), "\n".join(lines))
@@ -2,11 +2,13 @@
 
 import os
 import re
+import ConfigParser
 
+import RSV
 import Host
 import Table
-import Condor
 import Metric
+import Condor
 import Consumer
 import Sysutils
 
@@ -52,7 +54,7 @@ def list_metrics(rsv, options, pattern):
                 if options.list_cron:
                     # We need to load in the Metric with specific host so that
                     # we get the right cron time information.
-                    tmp_metric = Metric.Metric(metric, rsv, host.host)
+                    tmp_metric = rsv.get_metric(metric, host.host)
                     cron = tmp_metric.get_cron_string()
                     table.addToBuffer(metric, cron)
                 else:
@@ -120,7 +122,7 @@ def list_metrics(rsv, options, pattern):
 
 def job_list(rsv, parsable=False, hostname=None):
     """ Display jobs running similar to condor_cron_q but in a better format """
-    condor = Condor.Condor(rsv)
+    condor = Condor.Condor(rsv, hostname)
 
     if not condor.is_condor_running():
         rsv.echo("ERROR: condor-cron is not running.")
@@ -206,6 +208,9 @@ def dispatcher(rsv, action, options, jobs=None):
         num_errors = 0
         write_config_file = False
 
+        # Jobs to stop are collected so that they can be removed all at once
+        to_stop = []
+
         for job in jobs:
             is_metric   = job in available_metrics
             is_consumer = job in available_consumers
@@ -223,12 +228,12 @@ def dispatcher(rsv, action, options, jobs=None):
                     num_errors += 1
                     continue
 
-                metric = Metric.Metric(job, rsv, hostname)
+                metric = rsv.get_metric(job, hostname)
 
                 if action == "start":
                     num_errors += start_metric(rsv, condor, metric, host)
                 elif action == "stop":
-                    num_errors += stop_metric(rsv, condor, metric, host)
+                    to_stop.append(stop_metric(rsv, condor, metric, host))
                 elif action == "enable":
                     write_config_file |= enable_metric(rsv, metric, host, options.knobs)
                 elif action == "disable":
@@ -242,7 +247,7 @@ def dispatcher(rsv, action, options, jobs=None):
                 if action == "start":
                     num_errors += start_consumer(rsv, condor, consumer)
                 elif action == "stop":
-                    num_errors += stop_consumer(rsv, condor, consumer)
+                    to_stop.append(stop_consumer(rsv, condor, consumer))
                 elif action == "enable":
                     enable_consumer(rsv, consumer)
                 elif action == "disable":
@@ -250,6 +255,9 @@ def dispatcher(rsv, action, options, jobs=None):
                 elif action == "show-config":
                     show_config_consumer(rsv, consumer)
 
+        if to_stop:
+            num_errors += stop_jobs(rsv, condor, to_stop)
+
         if write_config_file:
             host.write_config_file()
 
@@ -274,28 +282,25 @@ def dispatcher(rsv, action, options, jobs=None):
 def start_all_jobs(rsv, condor):
     """ Start all metrics and consumers """
 
-    num_errors = 0
-
-    # Start all the metrics for each host
+    # Collect all the metrics for each host
+    metrics = []
     for host in rsv.get_host_info():
         enabled_metrics = host.get_enabled_metrics()
         if len(enabled_metrics) > 0:
             rsv.echo("Starting %s metrics for host '%s'." % (len(enabled_metrics), host.host))
             for metric_name in enabled_metrics:
-                metric = Metric.Metric(metric_name, rsv, host.host)
-                if not condor.start_metric(metric, host):
-                    num_errors += 1
+                metrics.append((rsv.get_metric(metric_name, host.host), host))
 
-    # Start the consumers
+    # And the consumers
     enabled_consumers = rsv.get_enabled_consumers()
     if len(enabled_consumers) > 0:
         rsv.echo("Starting %s consumers." % len(enabled_consumers))
-        for consumer in enabled_consumers:
-            if not condor.start_consumer(rsv, consumer):
-                num_errors += 1
     else:
         rsv.echo("No consumers are enabled.  Jobs will run but records will not be generated.")
 
+    # Submit them together, which is much faster than one at a time
+    num_errors = condor.start_jobs(metrics, enabled_consumers)
+
     if num_errors > 0:
         return False
 
@@ -329,12 +334,12 @@ def stop_all_jobs(rsv, condor):
     """ Stop all metrics """
 
     rsv.echo("Stopping all metrics on all hosts.")
-    if not condor.stop_jobs("OSGRSV==\"metrics\""):
+    if not condor.stop_rsv_jobs("OSGRSV", "metrics"):
         rsv.echo("ERROR: Problem stopping metrics.")
         return False
 
     rsv.echo("Stopping consumers.")
-    if not condor.stop_jobs("OSGRSV==\"consumers\""):
+    if not condor.stop_rsv_jobs("OSGRSV", "consumers"):
         rsv.echo("ERROR: Problem stopping consumers.")
         return False
 
@@ -342,21 +347,280 @@ def stop_all_jobs(rsv, condor):
 
 
 def stop_metric(rsv, condor, metric, host):
-    """ Stop a single metric against the specified host """
+    """ Announce that a metric against the specified host will be stopped and
+    return the unique name to pass to stop_jobs """
     rsv.echo("Stopping metric '%s' for host '%s'" % (metric.name, host.host))
-    metric = Metric.Metric(metric.name, rsv, host.host)
-    if not condor.stop_jobs("OSGRSVUniqueName==\"%s\"" % metric.get_unique_name()):
-        return 1
-
-    return 0
+    return metric.get_unique_name()
 
 def stop_consumer(rsv, condor, consumer):
-    """ Stop a single consumer """ 
+    """ Announce that a consumer will be stopped and return the unique name to
+    pass to stop_jobs """
     rsv.echo("Stopping consumer %s" % consumer.name)
-    if not condor.stop_jobs("OSGRSVUniqueName==\"%s\"" % consumer.get_unique_name()):
-        return 1
+    return consumer.get_unique_name()
 
-    return 0
+
+def stop_jobs(rsv, condor, unique_names):
+    """ Stop the metric and consumer jobs with the supplied unique names using a
+    single remove request.  Returns the number of jobs that could not be stopped. """
+
+    if condor.stop_unique_names(unique_names):
+        return 0
+
+    # Some of the jobs may have been removed anyway, or were not in the queue
+    failed = unique_names
+    snapshot = condor.get_snapshot(refresh=True)
+    if snapshot is not None:
+        failed = [name for name in unique_names if snapshot.find("OSGRSVUniqueName", name)]
+
+    for name in failed:
+        rsv.echo("ERROR: Could not stop job '%s'" % name)
+    return len(failed)
+
+
+def sync_jobs(rsv, hostname=None):
+    """ Make the jobs in condor-cron match the configuration: start the enabled
+    metrics and consumers that are not running, stop the jobs that are no longer
+    enabled, and restart the jobs whose submit description has changed.  All of
+    the jobs are stopped with one remove request and then submitted together.
+    If hostname is supplied only the metrics for that host are synced. """
+
+    condor = Condor.Condor(rsv, hostname)
+    snapshot = condor.get_snapshot()
+    if snapshot is None:
+        rsv.echo("ERROR: condor-cron is not running.")
+        return False
+
+    # The jobs that should be running, by unique name.  Jobs we cannot build a
+    # submit description for are left as they are.
+    wanted = {}
+    invalid = {}
+    if hostname:
+        hosts = [Host.Host(hostname, rsv)]
+    else:
+        hosts = rsv.get_host_info()
+    for host in hosts:
+        for metric_name in host.get_enabled_metrics():
+            metric = rsv.get_metric(metric_name, host.host)
+            job = condor.get_metric_job(metric)
+            if job is None:
+                invalid[metric.get_unique_name()] = 1
+            else:
+                wanted[job.condor_id] = job
+
+    if not hostname:
+        for consumer in rsv.get_enabled_consumers():
+            job = condor.get_consumer_job(consumer)
+            wanted[job.condor_id] = job
+
+    # Compare them with the jobs in the queue
+    stale = []
+    changed = []
+    running = {}
+    for classad in snapshot.classads:
+        name = classad.get("OSGRSVUniqueName", "").strip('"')
+        if not name or name in running or name in invalid:
+            continue
+        running[name] = 1
+
+        if name not in wanted:
+            stale.append(name)
+        elif len(snapshot.find("OSGRSVUniqueName", name)) > 1:
+            changed.append(name)
+        elif classad.get("OSGRSVSubmitHash", "").strip('"') != wanted[name].get_submit_hash():
+            changed.append(name)
+
+    missing = []
+    for name in wanted.keys():
+        if name not in running:
+            missing.append(name)
+
+    stale.sort()
+    changed.sort()
+    missing.sort()
+
+    if stale:
+        rsv.echo("Stopping %s jobs that are no longer enabled:" % len(stale))
+        for name in stale:
+            rsv.echo(name, 4)
+    if changed:
+        rsv.echo("Restarting %s jobs whose configuration changed:" % len(changed))
+        for name in changed:
+            rsv.echo(name, 4)
+    if missing:
+        rsv.echo("Starting %s jobs that are not running:" % len(missing))
+        for name in missing:
+            rsv.echo(name, 4)
+
+    num_errors = len(invalid)
+
+    if not condor.stop_unique_names(stale + changed):
+        rsv.echo("ERROR: Problem stopping jobs.")
+        return False
+
+    jobs = [wanted[name] for name in changed + missing]
+    if jobs:
+        num_errors += condor.submit_jobs(jobs)
+
+    rsv.echo("%s jobs were already up to date." % (len(running) - len(stale) - len(changed)))
+
+    if num_errors > 0:
+        rsv.log("ERROR", "Problem syncing %s jobs." % num_errors)
+        return False
+
+    return True
+
+
+def apply_config(rsv, manifest_file):
+    """ Make the configuration match a manifest file, which looks like:
+
+        [consumers]
+        enabled = html-consumer, gratia-consumer
+
+        [host ce.example.com]
+        metrics = org.osg.general.osg-version org.osg.general.vo-supported
+
+        [args ce.example.com org.osg.general.osg-version]
+        KEY = VAL
+
+    The metrics listed for a host are enabled and its other metrics are disabled.
+    Hosts that are not in the manifest are left alone.  An args section sets
+    knobs like --arg does.  The whole manifest is checked before anything is
+    written, and each file that needs to change is written once. """
+
+    if not os.path.exists(manifest_file):
+        rsv.echo("ERROR: Manifest file '%s' does not exist" % manifest_file)
+        return False
+
+    manifest = ConfigParser.RawConfigParser()
+    manifest.optionxform = str
+    try:
+        manifest.read(manifest_file)
+    except ConfigParser.ParsingError, err:
+        rsv.echo("ERROR: %s" % err)
+        return False
+
+    installed_metrics = rsv.get_installed_metrics()
+    installed_consumers = rsv.get_installed_consumers()
+
+    errors = []
+    consumers = None
+    hosts = []
+    host_metrics = {}
+    args = []
+    for section in manifest.sections():
+        words = section.split()
+        if section == "consumers":
+            consumers = get_manifest_list(manifest, section, "enabled", errors)
+            for consumer in consumers:
+                if consumer not in installed_consumers:
+                    errors.append("Consumer '%s' is not installed" % consumer)
+        elif len(words) == 2 and words[0] == "host":
+            hosts.append(words[1])
+            host_metrics[words[1]] = get_manifest_list(manifest, section, "metrics", errors)
+            for metric in host_metrics[words[1]]:
+                if metric not in installed_metrics:
+                    errors.append("Metric '%s' for host '%s' is not installed" % (metric, words[1]))
+        elif len(words) == 3 and words[0] == "args":
+            if words[2] not in installed_metrics:
+                errors.append("Metric '%s' in section [%s] is not installed" % (words[2], section))
+            args.append((words[1], words[2], manifest.items(section)))
+        else:
+            errors.append("Unknown section [%s]" % section)
+
+    # Work out what has to change.  Each entry is (path, ConfigParser).
+    writes = []
+
+    if consumers is not None and not errors:
+        enabled_consumers = rsv.get_enabled_consumers(want_objects=0)
+        enabled_consumers.sort()
+        wanted = consumers[:]
+        wanted.sort()
+        if enabled_consumers != wanted:
+            rsv.echo("Setting enabled consumers to: %s" % ", ".join(consumers))
+            rsv.set_enabled_consumers(consumers)
+            writes.append((RSV.CONSUMER_CONFIG_FILE, rsv.consumer_config))
+
+    for hostname in hosts:
+        if errors:
+            break
+        host = Host.Host(hostname, rsv)
+        changed = False
+        for metric in host_metrics[hostname]:
+            if not host.metric_enabled(metric):
+                rsv.echo("Enabling metric '%s' for host '%s'" % (metric, hostname))
+                host.set_config(metric, 1)
+                changed = True
+        for metric in host.get_enabled_metrics():
+            if metric not in host_metrics[hostname]:
+                rsv.echo("Disabling metric '%s' for host '%s'" % (metric, hostname))
+                host.set_config(metric, 0)
+                changed = True
+        if changed:
+            writes.append((host.config_file, host.config))
+
+    for (hostname, metric, knobs) in args:
+        if errors:
+            break
+        path = Metric.get_host_config_file(metric, hostname)
+        config = ConfigParser.RawConfigParser()
+        config.optionxform = str
+        if os.path.exists(path):
+            try:
+                config.read(path)
+            except ConfigParser.ParsingError, err:
+                errors.append(str(err))
+                break
+
+        section = "%s args" % metric
+        if not config.has_section(section):
+            config.add_section(section)
+
+        changed = False
+        for (key, value) in knobs:
+            if not config.has_option(section, key) or config.get(section, key) != value:
+                rsv.echo("Setting %s=%s for metric '%s' on host '%s'" % (key, value, metric, hostname))
+                config.set(section, key, value)
+                changed = True
+        if changed:
+            writes.append((path, config))
+
+    if errors:
+        for error in errors:
+            rsv.echo("ERROR: %s" % error)
+        rsv.echo("No changes were made.")
+        return False
+
+    for (path, config) in writes:
+        rsv.log("INFO", "Writing configuration file '%s'" % path)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            Sysutils.write_config(config, path)
+        except (IOError, OSError), err:
+            rsv.echo("ERROR: Could not write configuration file '%s': %s" % (path, err))
+            return False
+
+    if writes:
+        rsv.echo("Updated %s configuration files." % len(writes))
+    else:
+        rsv.echo("The configuration already matches '%s'." % manifest_file)
+
+    return True
+
+
+def get_manifest_list(manifest, section, option, errors):
+    """ Return the names in a comma or space separated option of the manifest.  A
+    missing option is added to errors. """
+
+    for extra in manifest.options(section):
+        if extra != option:
+            errors.append("Unknown option '%s' in section [%s]" % (extra, section))
+
+    if not manifest.has_option(section, option):
+        errors.append("Section [%s] has no '%s' option" % (section, option))
+        return []
+
+    return [name for name in re.split(r"[\s,]+", manifest.get(section, option)) if name]
 
 
 def enable_metric(rsv, metric, host, knobs):
@@ -22,7 +22,7 @@ def process_options(arguments=None):
     Level settings - 0=print nothing, 1=normal, 2=info, 3=debug
 
     Run a one-time test:
-    --run [--all-enabled] [--gatekeeper-type|--gk-type gram|condor-ce|cream|nordugrid] --host <HOST> METRIC [METRIC ...]
+    --run [--all-enabled] [--jobs N] [--deadline SECONDS] [--gatekeeper-type|--gk-type gram|condor-ce|cream|nordugrid] --host <HOST> METRIC [METRIC ...]
     --test (same options and behavior as --run but w/o generating records)
     
     Show information about enabled and installed metrics:
@@ -34,10 +34,12 @@ def process_options(arguments=None):
     Configure desired state of metrics and consumers:
     --enable  --host <host-name> METRIC|CONSUMER [METRIC|CONSUMER ...]
     --disable --host <host-name> METRIC|CONSUMER [METRIC|CONSUMER ...]
+    --apply <manifest-file> [--sync]
 
     Start and stop metrics and consumers:
     --on  [--host <host-name> [METRIC|CONSUMER ...]]
     --off [--host <host-name> [METRIC|CONSUMER ...]]
+    --sync [--host <host-name>]
 
     Other commands are available, run with --help to see full usage.
     """
@@ -59,7 +61,13 @@ def process_options(arguments=None):
                      help="Same as --run but do not generate records " +
                           "(therefore nothing goes to Gratia, HTML page, etc).")
     group.add_option("--all-enabled", action="store_true", dest="all_enabled", default=False,
-                     help="Run all enabled metrics serially.")
+                     help="Run all enabled metrics (serially unless --jobs is supplied).")
+    group.add_option("--jobs", dest="jobs", default=1, type="int", metavar="N",
+                     help="Run up to N metrics at the same time, each in its own process (with --run). " +
+                          "[Default=%default]")
+    group.add_option("--deadline", dest="deadline", default=None, type="int", metavar="SECONDS",
+                     help="Only start metrics that can finish (even if they run into their timeout) " +
+                          "within SECONDS of the start of the run.  Other metrics are reported as skipped.")
     group.add_option("--extra-config-file", dest="extra_config_file", default=None,
                      help="Path to another INI-format file containing metric configuration (with --run)")
     parser.add_option_group(group)
@@ -94,6 +102,13 @@ def process_options(arguments=None):
                       help="Turn on all enabled metrics.  If a metric is specified, turn on only that metric.")
     group.add_option("--off", action="store_true", dest="off", default=False,
                       help="Turn off all running metrics.  If a metric is specified, turn off only that metric.")
+    group.add_option("--sync", action="store_true", dest="sync", default=False,
+                     help="Turn on the enabled metrics and consumers that are not running, turn off the ones " +
+                     "that are no longer enabled, and restart the ones whose configuration changed.  If a " +
+                     "host is specified, only sync the metrics for that host.")
+    group.add_option("--apply", dest="apply", default=None, metavar="FILE",
+                     help="Enable and disable metrics and consumers and set metric arguments to match " +
+                     "the manifest FILE.  Combine with --sync to turn the jobs on and off to match.")
     group.add_option("--arg", action="append", dest="knobs", default=None,
                      help="KEY=VAL to pass to the metric.  This can be specified multiple times.")
     parser.add_option_group(group)
@@ -130,7 +145,12 @@ def process_options(arguments=None):
     # Check that we got exactly one command
     number_of_commands = len([i for i in [options.run, options.enable, options.disable, options.on,
                                           options.off, options.list, options.job_list, options.verify,
-                                          options.show_config, options.profile] if i])
+                                          options.show_config, options.profile, options.sync,
+                                          options.apply] if i])
+
+    # --apply can be followed by a --sync in the same run
+    if options.apply and options.sync:
+        number_of_commands -= 1
 
     if number_of_commands > 1:
         parser.error("You can use only one command.")
@@ -151,6 +171,12 @@ def process_options(arguments=None):
             parser.error("You must provide a list of metrics to run or else pass the " +
                          "--all-enabled flag to run all enabled metrics")
 
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if options.deadline is not None and options.deadline < 1:
+        parser.error("--deadline must be a positive number of seconds")
+
     if options.ce_type and options.ce_type not in ('gram', 'condor-ce', 'htcondor-ce', 'cream', 'nordugrid'):
         parser.error("Invalid value for --ce-type. "
                      "Valid values are 'gram' for Globus GRAM, 'htcondor-ce' (or 'condor-ce') for HTCondor-CE, 'cream' for CREAM-CE and 'nordugrid' for Nordugrid")
@@ -192,7 +218,7 @@ def main_rsv_control():
         this_uid = os.getuid()
         rsv_user = rsv.get_user()
         if this_uid != 0 and this_uid != pwd.getpwnam(rsv_user).pw_uid:
-            rsv.echo("ERROR: You must be either root or %s to run these commands: run, on, off, enable, disable" % rsv_user)
+            rsv.echo("ERROR: You must be either root or %s to run these commands: run, on, off, sync, enable, disable, apply" % rsv_user)
             return False
             
         if options.run:
@@ -204,6 +230,14 @@ def main_rsv_control():
             return actions.dispatcher(rsv, "start", options, args)
         elif options.off:
             return actions.dispatcher(rsv, "stop", options, args)
+        elif options.apply:
+            if not actions.apply_config(rsv, options.apply):
+                return False
+            if options.sync:
+                return actions.sync_jobs(rsv, options.host)
+            return True
+        elif options.sync:
+            return actions.sync_jobs(rsv, options.host)
         elif options.enable:
             return actions.dispatcher(rsv, "enable", options, args)
         elif options.disable:
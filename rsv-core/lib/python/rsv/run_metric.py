@@ -3,23 +3,81 @@
 # Standard libraries
 import re
 import os
-import pwd
 import sys
 import copy
-import shutil
+import time
 import tempfile
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 # RSV libraries
 import RSV
 import Metric
 import CondorG
 import Sysutils
+import HostGate
+import Dependencies
+import Scheduler
+import StateFile
 import CondorVanilla
+import GridJobManager
+
+# Shar files for globus-job-run are cached here
+PAYLOAD_DIR = os.path.join(Sysutils.RSV_TMP_DIR, "payloads")
+
+# Cached shar files that have not been used for this long are removed
+PAYLOAD_MAX_AGE = 7 * 24 * 60 * 60
+
+# The perl wrapper around a shar file.  It extracts the archive on the remote
+# host and runs the metric (the %s) in it.
+SHAR_HEADER = """#!/usr/bin/env perl
+
+use strict;
+use warnings;
+use File::Temp;
+
+if(system("which uudecode >/dev/null 2>&1") != 0) {
+    print "RSV BRIEF RESULTS:\n";
+    print "UNKNOWN\n";
+    print "Cannot extract the shar file on remote system because uudecode is missing.\n";
+    print "To solve this, install uudecode (provided by the sharutils RPM) on the remote system you are monitoring.\n";
+    exit 0;    
+}
+
+my $temp_dir = mkdtemp("rsv-shar-XXXXXXXX");
+chdir($temp_dir);
+my $out_file = "shar.sh";
+
+my $shar = join "", <DATA>;
+open(OUT, '>', $out_file) or die("cannot write to $out_file: $!");
+print OUT $shar;
+close(OUT);
+
+my $ret = system("/bin/sh shar.sh >shar.out 2>&1");
+if($ret != 0) {
+    print "RSV BRIEF RESULTS:\n";
+    print "UNKNOWN\n";
+    print "Failed to extract shar file.\n";
+    system("cat shar.out");
+}
+else {
+    system("./%s @ARGV");
+    chdir("..");
+    system("rm -fr $temp_dir");
+}
+
+__DATA__"""
 
 
 def ping_test(rsv, metric):
     """ Ping the remote host to make sure it's alive before we attempt
-    to run jobs """
+    to run jobs.  The result is cached per host for ping-cache-ttl seconds so
+    that all the metrics run against a host in that interval share one ping.
+    Returns True if the host is reachable.  Otherwise a result is recorded for
+    the metric and False is returned. """
 
     uri = metric.host
     if uri.find(":") > 0:
@@ -27,24 +85,46 @@ def ping_test(rsv, metric):
     else:
         host = uri
 
-    rsv.log("INFO", "Pinging host %s:" % host)
+    cache = StateFile.StateFile(rsv, "ping")
+    ttl = rsv.get_ping_cache_ttl()
+    entry = None
+    if ttl > 0:
+        entry = cache.get_entry(host, ttl)
 
-    # Send a single ping, with a timeout.  We just want to know if we can reach
-    # the remote host, we don't care about the latency unless it exceeds the timeout
-    cmd = ["/bin/ping", "-W", "3", "-c", "1", host]
-    try:
-        (ret, out, err) = rsv.run_command(cmd)
-    except Sysutils.TimeoutError, err:
-        rsv.results.ping_timeout(metric, " ".join(cmd), err)
-        sys.exit(1)
+    if entry:
+        (result, age) = entry
+        rsv.log("INFO", "Using ping result for host %s from %i seconds ago" % (host, age))
+        (status, cmd, out, err) = result
+    else:
+        rsv.log("INFO", "Pinging host %s:" % host)
+
+        # Send a single ping, with a timeout.  We just want to know if we can reach
+        # the remote host, we don't care about the latency unless it exceeds the timeout
+        cmd = ["/bin/ping", "-W", "3", "-c", "1", host]
+        try:
+            (ret, out, err) = rsv.run_command(cmd)
+            if ret:
+                status = "failure"
+            else:
+                status = "ok"
+        except Sysutils.TimeoutError, err:
+            (status, out, err) = ("timeout", "", str(err))
+
+        cmd = " ".join(cmd)
+        if ttl > 0:
+            cache.set(host, (status, cmd, out, err))
+
+    if status == "timeout":
+        rsv.results.ping_timeout(metric, cmd, err)
+        return False
 
     # If we can't ping the host, don't bother doing anything else
-    if ret:
+    if status == "failure":
         rsv.results.ping_failure(metric, out, err)
-        sys.exit(1)
+        return False
         
     rsv.log("INFO", "Ping successful", 4)
-    return
+    return True
 
 
 
@@ -68,21 +148,33 @@ def parse_job_output_wlcg(rsv, metric, stdout, stderr):
 
 
 def parse_job_output_multiple_wlcg(rsv, metric, stdout, stderr):
-    """ Parse multiple WLCG formatted records separated by EOT. """
+    """ Parse multiple WLCG formatted records separated by EOT.  Each record is
+    reported under the metric named in its metricName line (against the same
+    host), so consumers and dependent metrics see it under the right name. """
 
-    rsv.log("CRITICAL", "wlcg-multiple implementation may not be fully functional")
+    records = []
+    for record in re.split(r"(?m)^EOT[ \t\r]*$", stdout):
+        if re.search("^metricStatus:", record, re.MULTILINE):
+            records.append(record.strip("\r\n") + "\nEOT\n")
+        elif re.search("\S", record):
+            rsv.log("WARNING", "Ignoring text without a metricStatus in wlcg-multiple output:\n%s" % record)
 
-    records = stdout.split("\nEOT\n")
     rsv.echo("Parsing wlcg-multiple style record.  Found %s records" % len(records))
-    num = 1
-    for record in records:
-        if not re.search("\S", record):
-            continue
-        record += "\nEOT\n"
-        rsv.echo("Record %s of %s:" % (num, len(records)))
-        rsv.results.wlcg_result(metric, record, stderr)
+    if not records:
+        rsv.results.no_wlcg_records(metric, stdout, stderr)
+        return
+
+    for num in range(len(records)):
+        record = records[num]
+        record_metric = metric
+        match = re.search("^metricName: (\S+)", record, re.MULTILINE)
+        if match and match.group(1) != metric.name:
+            record_metric = copy.copy(metric)
+            record_metric.name = match.group(1)
+
+        rsv.echo("Record %s of %s:" % (num + 1, len(records)))
+        rsv.results.wlcg_result(record_metric, record, stderr)
         rsv.echo("\n")
-        num += 1
 
 
 def parse_job_output_brief(rsv, metric, stdout, stderr):
@@ -125,7 +217,8 @@ def parse_job_output_brief(rsv, metric, stdout, stderr):
 
 
 def execute_job(rsv, metric):
-    """ Execute the job """
+    """ Execute the job.  Returns a reason string if the job showed that the
+    remote host is unreachable, None otherwise. """
 
     execute_type = metric.config_get("execute").lower()
     if execute_type == "local":
@@ -134,7 +227,7 @@ def execute_job(rsv, metric):
     elif execute_type == "grid":
         if rsv.use_condor_g():
             rsv.log("INFO", "Executing job remotely using Condor-G")
-            execute_condor_g_job(rsv, metric)
+            return execute_condor_g_job(rsv, metric)
         else:
             rsv.log("INFO", "Executing job remotely using globus-job-run")
             execute_grid_job(rsv, metric)
@@ -145,7 +238,7 @@ def execute_job(rsv, metric):
         rsv.log("ERROR", "The execute type of the probe is unknown: '%s'" % execute_type)
         sys.exit(1)
 
-    return
+    return None
 
 
 def execute_local_job(rsv, metric):
@@ -166,18 +259,14 @@ def execute_local_job(rsv, metric):
     # can take a long time to run (many times longer than the average metric)
     job_timeout = metric.get_timeout()
 
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
+    env = get_job_environment(rsv, metric)
 
     try:
-        (ret, out, err) = rsv.run_command(job, job_timeout)
+        (ret, out, err) = rsv.run_command(job, job_timeout, env, rsv.get_capture_limit(), metric)
     except Sysutils.TimeoutError, err:
-        os.environ = original_environment
         rsv.results.job_timed_out(metric, " ".join(job), err)
         return
 
-    os.environ = original_environment
-
     if ret:
         rsv.results.local_job_failed(metric, " ".join(job), out, err)
         return
@@ -201,8 +290,8 @@ def execute_grid_job(rsv, metric):
 
     # If the probe depends on any modules we need to prepare a SHAR file to send
     # because globus-job-run can only send one file (it can't send supporting libraries)
-    (shar_dir, shar_file) = prepare_shar_file(rsv, metric)
-    if not shar_dir:
+    (shar_file, temporary) = prepare_shar_file(rsv, metric)
+    if not shar_file:
         return
 
     job = ["globus-job-run", "%s/jobmanager-%s" % (metric.host, jobmanager),
@@ -219,19 +308,17 @@ def execute_grid_job(rsv, metric):
     # can take a long time to run (many times longer than the average metric)
     job_timeout = metric.get_timeout()
 
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
+    env = get_job_environment(rsv, metric)
 
     try:
-        (ret, out, err) = rsv.run_command(job, job_timeout)
-    except Sysutils.TimeoutError, err:
-        os.environ = original_environment
-        shutil.rmtree(shar_dir)
-        rsv.results.job_timed_out(metric, " ".join(job), err)
-        return
-
-    os.environ = original_environment
-    shutil.rmtree(shar_dir)
+        try:
+            (ret, out, err) = rsv.run_command(job, job_timeout, env, rsv.get_capture_limit(), metric)
+        except Sysutils.TimeoutError, err:
+            rsv.results.job_timed_out(metric, " ".join(job), err)
+            return
+    finally:
+        if temporary:
+            os.remove(shar_file)
 
     if ret:
         rsv.results.grid_job_failed(metric, " ".join(job), out, err)
@@ -245,119 +332,132 @@ def prepare_shar_file(rsv, metric):
 
     globus-job-run can only send one file, so we will wrap up all the files into a
     sh archive.  But after unshar'ing we need to execute one of the files so we will
-    use a perl script to do the extraction followed by executing the necessary script """
+    use a perl script to do the extraction followed by executing the necessary script.
+
+    The shar files are kept in PAYLOAD_DIR, named after a hash of everything that
+    goes into them, so they are only rebuilt when one of the files changes.  If
+    the cache cannot be used the shar file is written to a temporary file instead.
+
+    Returns (path, temporary) where temporary is True if the caller has to remove
+    the file, or (None, False) if a result has been recorded for the metric. """
+
+    transfer_files = metric.get_transfer_files() or []
+    header = SHAR_HEADER % metric.name
+
+    # Hash the wrapper and the contents of every file in the archive
+    digest = md5(header)
+    for path in [metric.executable] + transfer_files:
+        try:
+            f = open(path, 'rb')
+            try:
+                digest.update("\0%s\0" % path)
+                digest.update(f.read())
+            finally:
+                f.close()
+        except IOError, err:
+            rsv.results.shar_creation_failed(metric, "", "Cannot read '%s': %s" % (path, err))
+            return (None, False)
+
+    # A cached file runs on the remote host with our credentials, so only use one
+    # that nobody but root and rsv could have written
+    shar_file = os.path.join(PAYLOAD_DIR, "%s.pl" % digest.hexdigest())
+    use_cache = Sysutils.make_rsv_dir(PAYLOAD_DIR)
+    if not use_cache:
+        rsv.log("WARNING", "'%s' could not be created or is not owned by root or rsv.  " % PAYLOAD_DIR +
+                "The shar file will not be cached.")
+    elif Sysutils.is_trusted(shar_file):
+        rsv.log("INFO", "Using cached shar file '%s'" % shar_file)
+        try:
+            # Mark it as recently used so that prune_shar_files keeps it
+            os.utime(shar_file, None)
+        except OSError:
+            pass
+        return (shar_file, False)
+    elif os.path.lexists(shar_file):
+        rsv.log("WARNING", "Not using cached shar file '%s' because it is not owned by root or rsv " % shar_file +
+                "or can be written by others")
 
     # Check for shar
     utils = Sysutils.Sysutils(rsv)
     path = utils.which("shar")
     if not path:
         rsv.results.shar_not_installed(metric)
-        return None, None
-
-    # Make a temporary path to create the shar file
-    parent_dir = os.path.join("/", "var", "tmp", "rsv")
-    if not os.path.exists(parent_dir):
-        # /var/tmp/rsv can be periodically deleted by system cleanup utilities so we sometimes
-        # have to re-create it
-        os.mkdir(parent_dir, 0755)
-        (uid, gid) = pwd.getpwnam('rsv')[2:4]
-        os.chown(parent_dir, uid, gid)
-    tempdir = tempfile.mkdtemp(prefix="shar-", dir=parent_dir)
-    shar_file = os.path.join(tempdir, "shar.pl")
-
-    # Make a perl header for the shar file
-    f = open(shar_file, 'w')
-    f.write("""#!/usr/bin/env perl
-
-use strict;
-use warnings;
-use File::Temp;
-
-if(system("which uudecode >/dev/null 2>&1") != 0) {
-    print "RSV BRIEF RESULTS:\n";
-    print "UNKNOWN\n";
-    print "Cannot extract the shar file on remote system because uudecode is missing.\n";
-    print "To solve this, install uudecode (provided by the sharutils RPM) on the remote system you are monitoring.\n";
-    exit 0;    
-}
-
-my $temp_dir = mkdtemp("rsv-shar-XXXXXXXX");
-chdir($temp_dir);
-my $out_file = "shar.sh";
-
-my $shar = join "", <DATA>;
-open(OUT, '>', $out_file) or die("cannot write to $out_file: $!");
-print OUT $shar;
-close(OUT);
-
-my $ret = system("/bin/sh shar.sh >shar.out 2>&1");
-if($ret != 0) {
-    print "RSV BRIEF RESULTS:\n";
-    print "UNKNOWN\n";
-    print "Failed to extract shar file.\n";
-    system("cat shar.out");
-}
-else {
-    system("./%s @ARGV");
-    chdir("..");
-    system("rm -fr $temp_dir");
-}
-
-__DATA__""" % metric.name)
-    f.close()
+        return (None, False)
 
     # Create the shar file
-    transfer_files = metric.get_transfer_files()
     cmd = ["shar", "-f", metric.executable] + transfer_files
     (ret, out, err) = rsv.run_command(cmd)
     if ret != 0:
         rsv.results.shar_creation_failed(metric, out, err)
-        return None, None
+        return (None, False)
+
+    if use_cache:
+        # Write it under a temporary name and rename it so that another run never
+        # sees a partial file
+        try:
+            prune_shar_files(rsv)
+            temp_file = write_shar_file(PAYLOAD_DIR, header + out)
+            try:
+                os.rename(temp_file, shar_file)
+            except OSError:
+                os.remove(temp_file)
+                raise
+            rsv.log("INFO", "Created shar file '%s'" % shar_file)
+            return (shar_file, False)
+        except (IOError, OSError), err:
+            rsv.log("WARNING", "Could not cache shar file '%s': %s" % (shar_file, err))
 
-    f = open(shar_file, 'a')
-    f.write(out)
-    f.close()
+    try:
+        temp_file = write_shar_file(None, header + out)
+    except (IOError, OSError), err:
+        rsv.results.shar_creation_failed(metric, "", "Could not write shar file: %s" % err)
+        return (None, False)
 
-    return tempdir, shar_file
-    
-def execute_condor_vanilla_job(rsv,metric):
-    """ Execute a Vanilla job """
-    # Submit the job                                                                                                                                                              
-    condorvanilla = CondorVanilla.CondorVanilla(rsv)
+    rsv.log("INFO", "Created temporary shar file '%s'" % temp_file)
+    return (temp_file, True)
 
-    attrs = {}
-    if rsv.get_extra_globus_rsl():
-        attrs["globus_rsl"] = rsv.get_extra_globus_rsl()
-
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
 
-    ret = condorvanilla.submit(metric, attrs)
+def write_shar_file(directory, contents):
+    """ Write contents to a new file in directory (or in the system's temporary
+    directory if directory is None) and return its path """
 
-    os.environ = original_environment
+    (fd, path) = tempfile.mkstemp(prefix="shar-", dir=directory)
+    try:
+        f = os.fdopen(fd, 'w')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        os.chmod(path, 0644)
+    except (IOError, OSError):
+        os.remove(path)
+        raise
+
+    return path
+
+
+def prune_shar_files(rsv):
+    """ Remove the cached shar files that have not been used for PAYLOAD_MAX_AGE
+    seconds, along with temporary files left behind by interrupted runs """
+
+    cutoff = time.time() - PAYLOAD_MAX_AGE
+    for name in os.listdir(PAYLOAD_DIR):
+        path = os.path.join(PAYLOAD_DIR, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                rsv.log("DEBUG", "Removing old shar file '%s'" % path)
+                os.remove(path)
+        except OSError, err:
+            rsv.log("WARNING", "Could not remove old shar file '%s'.  Error %s" % (path, err))
 
 
-    if not ret:
-        rsv.results.condor_g_globus_submission_failed(metric)
+def execute_condor_vanilla_job(rsv,metric):
+    """ Execute a Vanilla job """
+    condorvanilla = CondorVanilla.CondorVanilla(rsv)
+    if not submit_condor_job(rsv, metric, condorvanilla):
         return
 
-    ret = condorvanilla.wait()
-
-    if ret == 0:
-        parse_job_output(rsv, metric, condorvanilla.get_stdout(), condorvanilla.get_stderr())
-    elif ret == 1:
-        rsv.results.condor_grid_job_aborted(metric, condorvanilla.get_log_contents())
-    elif ret == 2:
-        rsv.results.condor_grid_job_failed(metric, condorvanilla.get_stdout(), condorvanilla.get_stderr(), condorvanilla.get_log_contents())
-    elif ret == 3:
-        rsv.results.condor_g_globus_submission_failed(metric, condorvanilla.get_log_contents())
-    elif ret == 4:
-        rsv.results.condor_g_remote_gatekeeper_down(metric, condorvanilla.get_log_contents())
-    elif ret == 5:
-        rsv.results.job_timed_out(metric, "condor-g submission", "", info=condorvanilla.get_log_contents())
-    elif ret == 6:
-        rsv.results.job_was_held(metric, condorvanilla.get_log_contents())
-
+    report_condor_job(rsv, metric, condorvanilla, condorvanilla.wait())
     return
 
 
@@ -365,82 +465,242 @@ def execute_condor_g_job(rsv, metric):
     """ Execute a remote job via Condor-G.  This is the preferred format so that we
     can support both Globus and CREAM """
 
-    # Submit the job
     condorg = CondorG.CondorG(rsv)
+    if not submit_condor_job(rsv, metric, condorg):
+        return None
+
+    return report_condor_job(rsv, metric, condorg, condorg.wait())
+
+
+def get_condor_job_class(rsv, metric):
+    """ Return the class (CondorG or CondorVanilla) that runs the metric's job, or
+    None if it does not run under Condor """
+
+    execute_type = metric.config_get("execute").lower()
+    if execute_type == "grid" and rsv.use_condor_g():
+        return CondorG.CondorG
+    elif execute_type == "vanilla":
+        return CondorVanilla.CondorVanilla
+    return None
 
+
+def get_condor_job_attrs(rsv):
+    """ Return the extra submit file attributes for Condor-G and Vanilla jobs """
     attrs = {}
     if rsv.get_extra_globus_rsl():
         attrs["globus_rsl"] = rsv.get_extra_globus_rsl()
+    return attrs
 
-    original_environment = copy.copy(os.environ)
-    setup_job_environment(rsv, metric)
 
-    ret = condorg.submit(metric, attrs)
+def submit_condor_job(rsv, metric, job):
+    """ Submit a Condor-G or Vanilla job for the metric.  Returns True on success,
+    otherwise a result is recorded and False is returned. """
 
-    os.environ = original_environment
+    env = get_job_environment(rsv, metric)
 
-    if not ret:
+    if not job.submit(metric, get_condor_job_attrs(rsv), env=env):
         rsv.results.condor_g_globus_submission_failed(metric)
-        return
+        return False
+
+    return True
+
+
+def add_to_bundle(rsv, bundles, metric, label):
+    """ Hold a grid metric back to be submitted with the other grid metrics against
+    the same host and grid resource (see submit_bundles) """
+
+    env = get_job_environment(rsv, metric)
+    resource = CondorG.CondorG(rsv).get_resource(metric, env)
+    for (other_resource, entries) in bundles:
+        if other_resource == resource:
+            entries.append((metric, label))
+            return
+    bundles.append((resource, [(metric, label)]))
+
+
+def is_bundled(bundles, metric_names):
+    """ Return True if any of the metrics are waiting in a bundle """
+    for (resource, entries) in bundles:
+        for (metric, label) in entries:
+            if metric.name in metric_names:
+                return True
+    return False
+
+
+def submit_bundles(rsv, manager, bundles, deadline):
+    """ Submit one Condor-G job for each bundle of metrics and empty the list.  A
+    bundle job may take as long as all of its metrics together, so metrics that
+    would make it run past the deadline are left out. """
 
-    ret = condorg.wait()
+    for (resource, entries) in bundles:
+        allowed = deadline.allows_bundle([entry[0] for entry in entries])
+        metrics = [entry[0] for entry in entries if entry[0] in allowed]
+        labels = [entry[1] for entry in entries if entry[0] in allowed]
+        if not metrics:
+            continue
+        job = manager.new_job(CondorG.CondorG)
+
+        if len(metrics) == 1:
+            if submit_condor_job(rsv, metrics[0], job):
+                manager.add(metrics, job, labels)
+            else:
+                rsv.echo(labels[0])
+            continue
+
+        env = get_job_environment(rsv, metrics[0])
+        if job.submit_bundle(metrics, get_condor_job_attrs(rsv), env=env):
+            manager.add(metrics, job, labels)
+        else:
+            for index in range(len(metrics)):
+                rsv.echo(labels[index])
+                rsv.results.condor_g_globus_submission_failed(metrics[index])
+
+    del bundles[:]
+
+
+def report_condor_job(rsv, metric, job, ret):
+    """ Record the result of a finished Condor-G or Vanilla job.  ret is the value
+    returned by CondorG.wait.  Returns a reason string if the job showed that the
+    remote host is unreachable, None otherwise. """
 
     if ret == 0:
-        parse_job_output(rsv, metric, condorg.get_stdout(), condorg.get_stderr())
+        parse_job_output(rsv, metric, job.get_stdout(), job.get_stderr())
     elif ret == 1:
-        rsv.results.condor_grid_job_aborted(metric, condorg.get_log_contents())
+        rsv.results.condor_grid_job_aborted(metric, job.get_log_contents())
     elif ret == 2:
-        rsv.results.condor_grid_job_failed(metric, condorg.get_stdout(), condorg.get_stderr(), condorg.get_log_contents())
+        rsv.results.condor_grid_job_failed(metric, job.get_stdout(), job.get_stderr(), job.get_log_contents())
     elif ret == 3:
-        rsv.results.condor_g_globus_submission_failed(metric, condorg.get_log_contents())
+        rsv.results.condor_g_globus_submission_failed(metric, job.get_log_contents())
     elif ret == 4:
-        rsv.results.condor_g_remote_gatekeeper_down(metric, condorg.get_log_contents())
+        rsv.results.condor_g_remote_gatekeeper_down(metric, job.get_log_contents())
+        if isinstance(job, CondorVanilla.CondorVanilla):
+            return None
+        return "Condor-G detected that the remote gatekeeper is down"
     elif ret == 5:
-        rsv.results.job_timed_out(metric, "condor-g submission", "", info=condorg.get_log_contents())
+        rsv.results.job_timed_out(metric, "condor-g submission", "", info=job.get_log_contents())
     elif ret == 6:
-        rsv.results.job_was_held(metric, condorg.get_log_contents())
+        rsv.results.job_was_held(metric, job.get_log_contents())
 
-    return
+    return None
+
+
+def report_bundle_job(rsv, grid_job):
+    """ Record the result of each metric in a finished bundle job.  Returns a reason
+    string if the job showed that the remote host is unreachable, None otherwise. """
 
+    job = grid_job.job
+    reason = None
+
+    outputs = {}
+    if grid_job.outcome == 0:
+        stderr = job.get_stderr()
+        outputs = job.get_bundle_outputs()
+
+    for index in range(len(grid_job.metrics)):
+        metric = grid_job.metrics[index]
+        rsv.echo(grid_job.labels[index])
+
+        if grid_job.outcome != 0:
+            reason = report_condor_job(rsv, metric, job, grid_job.outcome) or reason
+        elif metric.name in outputs:
+            (ret, seconds, output) = outputs[metric.name]
+            rsv.log("INFO", "Metric %s exited with code %s after %s seconds in the bundle job" %
+                    (metric.name, ret, seconds))
+            metric.performance = Sysutils.ResourceUsage(seconds)
+            parse_job_output(rsv, metric, output, stderr)
+        else:
+            rsv.log("WARNING", "The bundle job did not return output for metric %s" % metric.name)
+            rsv.results.condor_grid_job_failed(metric, job.get_stdout(), stderr, job.get_log_contents())
+
+    return reason
+
+
+def finish_grid_jobs(rsv, manager, gate, deadline, wait=True):
+    """ Wait for the jobs submitted through the GridJobManager and record their
+    results as they finish.  Jobs still running at the deadline are timed out.
+    If wait is False only the jobs that have already finished are recorded.
+    Returns False if any of them showed that their host is unreachable. """
+
+    unreachable = []
+
+    def report(grid_job):
+        if grid_job.is_bundle():
+            reason = report_bundle_job(rsv, grid_job)
+        else:
+            rsv.echo(grid_job.labels[0])
+            reason = report_condor_job(rsv, grid_job.metrics[0], grid_job.job, grid_job.outcome)
+        if not reason:
+            return
+
+        host = grid_job.metrics[0].host
+        gate.mark_down(host, reason)
+        unreachable.append(host)
+
+        # The other jobs against the host would only run into the same problem
+        for other in manager.cancel_host(host):
+            for index in range(len(other.metrics)):
+                rsv.echo(other.labels[index])
+                rsv.results.host_unreachable(other.metrics[index], reason)
+
+    if wait:
+        manager.wait_all(report, deadline.end_time)
+    else:
+        manager.poll(report)
+    return not unreachable
 
-def setup_job_environment(rsv, metric):
-    """ Set the appropriate environment values that a metric expects """
+
+def get_job_environment(rsv, metric):
+    """ Return the environment that a metric expects, as a new dictionary based on
+    our own environment.  This is passed to the job instead of modifying
+    os.environ, so it does not affect anything else running in this process. """
 
     rsv.log("INFO", "Setting up job environment:")
 
+    job_env = os.environ.copy()
+
+    # Globus needs help finding the proxy since it probably does not have the
+    # default naming scheme of /tmp/x509_u<UID>
+    proxy = rsv.get_proxy()
+    if proxy:
+        job_env["X509_USER_PROXY"] = proxy
+        job_env["X509_PROXY_FILE"] = proxy
+
     env = metric.get_environment()
 
     if not env:
         rsv.log("INFO", "No environment setup declared", 4)
-        return
+        return job_env
     
     for var in env.keys():
         (action, value) = env[var]
         action = action.upper()
         rsv.log("INFO", "Var: '%s' Action: '%s' Value: '%s'" % (var, action, value), 4)
         if action == "APPEND":
-            if var in os.environ:
-                os.environ[var] = os.environ[var] + ":" + value
+            if var in job_env:
+                job_env[var] = job_env[var] + ":" + value
             else:
-                os.environ[var] = value
-            rsv.log("DEBUG", "New value of %s:\n%s" % (var, os.environ[var]), 8)
+                job_env[var] = value
+            rsv.log("DEBUG", "New value of %s:\n%s" % (var, job_env[var]), 8)
         elif action == "PREPEND":
-            if var in os.environ:
-                os.environ[var] = value + ":" + os.environ[var]
+            if var in job_env:
+                job_env[var] = value + ":" + job_env[var]
             else:
-                os.environ[var] = value
-            rsv.log("DEBUG", "New value of %s:\n%s" % (var, os.environ[var]), 8)
+                job_env[var] = value
+            rsv.log("DEBUG", "New value of %s:\n%s" % (var, job_env[var]), 8)
         elif action == "SET":
-            os.environ[var] = value
+            job_env[var] = value
         elif action == "UNSET":
-            if var in os.environ:
-                del os.environ[var]
+            if var in job_env:
+                del job_env[var]
 
-    return
+    return job_env
 
 def main(rsv, options, metrics):
     """ Main subroutine: directs program flow """
 
+    # The deadline counts from when the run starts
+    deadline = Scheduler.Deadline(rsv, options.deadline)
+
     hosts = {}
     total = 0
 
@@ -454,12 +714,84 @@ def main(rsv, options, metrics):
 
     RSV.validate_config(rsv)
 
+    # With --jobs the metrics are handed to a pool of worker processes
+    parallel = options.jobs > 1 and total > 1
+
+    # Hosts found to be unreachable are not contacted again by later metrics in
+    # this run.  The workers of a parallel run share what they find.
+    gate = HostGate.get_gate(rsv, parallel)
+
+    # Metrics whose prerequisites are failing are not run
+    dependencies = Dependencies.Dependencies(rsv)
+
+    if parallel:
+        scheduler = Scheduler.Scheduler(rsv, options, options.jobs, gate, deadline, dependencies)
+        for host in hosts:
+            for metric_name in hosts[host]:
+                scheduler.add(host, metric_name)
+        try:
+            return scheduler.run()
+        finally:
+            gate.close()
+
+    # When running several metrics, Condor-G and Vanilla jobs are submitted as we
+    # come to them and then waited for together
+    manager = None
+    if total > 1:
+        manager = GridJobManager.GridJobManager(rsv)
+
+    # Grid metrics held back to be submitted together, if bundle-grid-metrics is set
+    bundle_grid_metrics = manager and rsv.bundle_grid_metrics()
+    bundles = []
+
     # Process the command line and initialize
     count = 0
+    all_hosts_up = True
     for host in hosts:
+        # Run the metrics that others depend on first
+        host_metrics = []
         for metric_name in hosts[host]:
+            host_metrics.append(Metric.Metric(metric_name, rsv, host, options))
+
+        for metric in Dependencies.order_metrics(rsv, host_metrics):
             count += 1
-            metric = Metric.Metric(metric_name, rsv, host, options)
+
+            if total > 1:
+                header = "\nRunning metric %s (%s of %s)\n" % (metric.name, count, total)
+            else:
+                header = "\nRunning metric %s:\n" % metric.name
+
+            # A metric has to wait for the grid jobs of its prerequisites
+            if bundles and is_bundled(bundles, metric.get_dependencies()):
+                submit_bundles(rsv, manager, bundles, deadline)
+            if manager and manager.is_running(host, metric.get_dependencies()):
+                if not finish_grid_jobs(rsv, manager, gate, deadline):
+                    all_hosts_up = False
+
+            # Record the grid jobs that have already finished, so that nothing more
+            # is submitted to a host one of them found to be down
+            if manager and not finish_grid_jobs(rsv, manager, gate, deadline, wait=False):
+                all_hosts_up = False
+
+            # A failed ping does not stop a metric that skips the ping check
+            skip_ping = options.no_ping or metric.config_getboolean('no-ping') == True
+
+            # Don't run anything against a host that is already known to be down
+            reason = gate.get_reason(host, skip_ping)
+            if reason:
+                rsv.echo(header)
+                rsv.results.host_unreachable(metric, reason)
+                all_hosts_up = False
+                continue
+
+            prerequisite = dependencies.get_failed_prerequisite(metric)
+            if prerequisite:
+                rsv.echo(header)
+                rsv.results.prerequisite_failed(metric, prerequisite[0], prerequisite[1])
+                continue
+
+            if not deadline.allows(metric):
+                continue
 
             # Check for some basic error conditions
             rsv.check_proxy(metric)
@@ -468,14 +800,40 @@ def main(rsv, options, metrics):
                 rsv.log("INFO", "Skipping ping check because --no-ping was supplied")
             elif metric.config_getboolean('no-ping') == True:
                 rsv.log("INFO", "Skipping ping check because metric config contains no-ping=True")
-            else:
-                ping_test(rsv, metric)
+            elif not ping_test(rsv, metric):
+                gate.mark_down(host, "Failed to ping host %s" % host, ping=True)
+                all_hosts_up = False
+                continue
+
+            # Condor jobs are only submitted here.  Their results are recorded once
+            # they finish.
+            job_class = get_condor_job_class(rsv, metric)
+            if bundle_grid_metrics and job_class is CondorG.CondorG:
+                add_to_bundle(rsv, bundles, metric, header)
+                continue
+            elif manager and job_class:
+                # Pinging may have used up some of the time left
+                if not deadline.allows(metric):
+                    continue
+                job = manager.new_job(job_class)
+                if submit_condor_job(rsv, metric, job):
+                    manager.add([metric], job, [header])
+                else:
+                    rsv.echo(header)
+                continue
 
             # Run the job and parse the result
-            if total > 1:
-                rsv.echo("\nRunning metric %s (%s of %s)\n" % (metric.name, count, total))
-            else:
-                rsv.echo("\nRunning metric %s:\n" % metric.name)
-            execute_job(rsv, metric)
+            rsv.echo(header)
+            reason = execute_job(rsv, metric)
+            if reason:
+                gate.mark_down(host, reason)
+                all_hosts_up = False
 
-    return True
+        if bundles:
+            submit_bundles(rsv, manager, bundles, deadline)
+
+    if manager and not finish_grid_jobs(rsv, manager, gate, deadline):
+        all_hosts_up = False
+
+    deadline.report()
+    return all_hosts_up and not deadline.skipped